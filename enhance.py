@@ -20,15 +20,27 @@ import io
 import os
 import sys
 import bz2
+import zlib
 import glob
+import json
+import queue
 import math
 import time
 import pickle
+import platform
+import hashlib
+import struct
 import random
 import argparse
 import itertools
+import shutil
 import threading
+import subprocess
+import concurrent.futures
+import multiprocessing
 import collections
+import socketserver
+import http.server
 
 
 # Configure all options first so we can later custom-load other libraries (Theano) based on device specified by user.
@@ -38,8 +50,22 @@ add_arg = parser.add_argument
 add_arg('files',                nargs='*', default=[])
 add_arg('--zoom',               default=2, type=int,                help='Resolution increase factor for inference.')
 add_arg('--rendering-tile',     default=80, type=int,               help='Size of tiles used for rendering images.')
-add_arg('--rendering-overlap',  default=24, type=int,               help='Number of pixels padding around each tile.')
+add_arg('--rendering-overlap',  default=None, type=int,             help='Pixels padding each tile, default minimal.')
+add_arg('--rendering-feather',  default=0, type=int,                help='Pixels of overlap blended between tiles.')
+add_arg('--rendering-report',   default=False, action='store_true', help='Show redundant computation of tile settings.')
 add_arg('--rendering-histogram',default=False, action='store_true', help='Match color histogram of output to input.')
+add_arg('--rendering-batch',    default=1, type=int,                help='Tiles per network call, 0 picks from memory.')
+add_arg('--rendering-memory',   default=1024, type=int,             help='Megabytes available for a batch of tiles.')
+add_arg('--rendering-tune',     default=False, action='store_true', help='Measure fastest tile & batch size, cached.')
+add_arg('--rendering-cores',    default=None, type=int,             help='Cores to tune for, all of them by default.')
+add_arg('--rendering-stream',   default=None, choices=['png','npy'], help='Render in bands straight to disk.')
+add_arg('--rendering-pipeline', default=2, type=int,                help='Images decoded & encoded ahead in threads.')
+add_arg('--rendering-flat',     default=None, type=float,           help='Upscale tiles below this variance directly.')
+add_arg('--rendering-cache',    default=0, type=int,                help='Rendered tiles kept to reuse if identical.')
+add_arg('--manifest',           default=None, type=str,             help='File tracking inputs that are up to date.')
+add_arg('--watch',              default=0, type=float,              help='Poll for new input files every N seconds.')
+add_arg('--video',              default=False, action='store_true', help='Inputs are video files or folders of frames.')
+add_arg('--video-threshold',    default=None, type=float,           help='Reuse tiles changed less since last frame.')
 add_arg('--type',               default='photo', type=str,          help='Name of the neural network to load/save.')
 add_arg('--model',              default='default', type=str,        help='Specific trained version of the model.')
 add_arg('--train',              default=False, type=str,            help='File pattern to load for training.')
@@ -47,13 +73,23 @@ add_arg('--train-scales',       default=0, type=int,                help='Random
 add_arg('--train-blur',         default=None, type=int,             help='Sigma value for gaussian blur preprocess.')
 add_arg('--train-noise',        default=None, type=float,           help='Radius for preprocessing gaussian blur.')
 add_arg('--train-jpeg',         default=[], nargs='+', type=int,    help='JPEG compression level & range in preproc.')
+add_arg('--train-resample',     default='lanczos', choices=['lanczos', 'area'], help='Filter to downscale seeds.')
+add_arg('--train-vectorize',    default=False, action='store_true', help='Degrade fragments in batches with NumPy.')
+add_arg('--train-prepare',      default=None, type=str,             help='Store training fragments in this folder.')
+add_arg('--train-variants',     default=1, type=int,                help='Degraded seeds prepared for each fragment.')
+add_arg('--train-metrics',      default=None, type=str,             help='File to append per-step timings as JSON.')
+add_arg('--train-summary',      default=0, type=int,                help='Print a timing summary every N batches.')
+add_arg('--train-processes',    default=1, type=int,                help='Processes training on a batch each in sync.')
 add_arg('--epochs',             default=10, type=int,               help='Total number of iterations in training.')
 add_arg('--epoch-size',         default=72, type=int,               help='Number of batches trained in an epoch.')
 add_arg('--save-every',         default=10, type=int,               help='Save generator after every training epoch.')
+add_arg('--save-keep',          default=0, type=int,                help='Number of training checkpoints to keep.')
+add_arg('--resume',             default=False, action='store_true', help='Continue training from the last checkpoint.')
 add_arg('--batch-shape',        default=192, type=int,              help='Resolution of images in training batch.')
 add_arg('--batch-size',         default=15, type=int,               help='Number of images per training batch.')
 add_arg('--buffer-size',        default=1500, type=int,             help='Total image fragments kept in cache.')
 add_arg('--buffer-fraction',    default=5, type=int,                help='Fragments cached for each image loaded.')
+add_arg('--buffer-workers',     default=0, type=int,                help='Processes loading images, 0 uses a thread.')
 add_arg('--learning-rate',      default=1E-4, type=float,           help='Parameter for the ADAM optimizer.')
 add_arg('--learning-period',    default=75, type=int,               help='How often to decay the learning rate.')
 add_arg('--learning-decay',     default=0.5, type=float,            help='How much to decay the learning rate.')
@@ -64,6 +100,9 @@ add_arg('--generator-blocks',   default=4, type=int,                help='Number
 add_arg('--generator-residual', default=2, type=int,                help='Number of layers in a residual block.')
 add_arg('--perceptual-layer',   default='conv2_2', type=str,        help='Which VGG layer to use as loss component.')
 add_arg('--perceptual-weight',  default=1e0, type=float,            help='Weight for VGG-layer perceptual loss.')
+add_arg('--perceptual-cache',   default=0, type=int,                help='Fragments with cached features of real data.')
+add_arg('--pixel-weight',       default=0.0, type=float,            help='Weight of mean squared error on pixels.')
+add_arg('--distill',            default=None, type=str,             help='Trained model to imitate, e.g. `default`.')
 add_arg('--discriminator-size', default=32, type=int,               help='Multiplier for number of filters in D.')
 add_arg('--smoothness-weight',  default=2e5, type=float,            help='Weight of the total-variation loss.')
 add_arg('--adversary-weight',   default=5e2, type=float,            help='Weight of adversarial loss compoment.')
@@ -71,7 +110,21 @@ add_arg('--generator-start',    default=0, type=int,                help='Epoch
 add_arg('--discriminator-start',default=1, type=int,                help='Epoch count to update the discriminator.')
 add_arg('--adversarial-start',  default=2, type=int,                help='Epoch for generator to use discriminator.')
 add_arg('--device',             default='cpu', type=str,            help='Name of the CPU/GPU to use, for Theano.')
-args = parser.parse_args()
+add_arg('--backend',            default='theano', choices=['theano', 'numpy'], help='Library used to run inference.')
+add_arg('--server',             default=None, type=str,             help='Serve requests on `host:port` or a socket.')
+add_arg('--server-batch',       default=32, type=int,               help='Maximum tiles merged into one network call.')
+add_arg('--server-window',      default=10.0, type=float,           help='Milliseconds to wait for tiles to merge.')
+add_arg('--server-queue',       default=64, type=int,               help='Requests in progress before refusing more.')
+add_arg('--convert',            default=False, action='store_true', help='Convert model files to fast-loading format.')
+add_arg('--benchmark',          default=None, type=str,             help='Measure rendering speed, saving JSON here.')
+add_arg('--benchmark-sizes',    default=[256, 512, 1024], nargs='+', type=int, help='Sizes of synthetic images.')
+add_arg('--benchmark-tiles',    default=[64, 80, 128], nargs='+', type=int, help='Tile sizes to benchmark.')
+add_arg('--benchmark-overlaps', default=[], nargs='+', type=int,    help='Tile overlaps, receptive field by default.')
+add_arg('--benchmark-batches',  default=[1, 4, 16], nargs='+', type=int, help='Tiles per network call.')
+add_arg('--backend-tolerance',  default=None, type=float,           help='Verify NumPy output against Theano.')
+add_arg('--quantize',           default=None, choices=['fp16', 'int8'], help='Lower precision, saves memory only.')
+add_arg('--quantize-samples',   default=[], nargs='+', type=str,    help='Images to calibrate the activation ranges.')
+add_arg('--quantize-report',    default=False, action='store_true', help='Compare quantized output with float32.')
 
 
 #----------------------------------------------------------------------------------------------------------------------
@@ -101,43 +154,212 @@ def warn(message, *lines):
 
 def extend(lst): return itertools.chain(lst, itertools.repeat(lst[-1]))
 
-print("""{}   {}Super Resolution for images and videos powered by Deep Learning!{}
-  - Code licensed as AGPLv3, models under CC BY-NC-SA.{}""".format(ansi.CYAN_B, __doc__, ansi.CYAN, ansi.ENDC))
-
-# Load the underlying deep learning libraries based on the device specified.  If you specify THEANO_FLAGS manually,
-# the code assumes you know what you are doing and they are not overriden!
-os.environ.setdefault('THEANO_FLAGS', 'floatX=float32,device={},force_device=True,allow_gc=True,'\
-                                      'print_active_device=False'.format(args.device))
+def configure(*argv, **options):
+    """Create options for using this file as a library, parsed from command-line arguments then overriden by
+    keywords, for example `configure('--device=gpu', zoom=4, model='repair')`.
+    """
+    config = parser.parse_args(list(argv))
+    for k, v in options.items():
+        if not hasattr(config, k): raise TypeError("Unknown option `{}` for configuration.".format(k))
+        setattr(config, k, v)
+    return config
+
+def copy_config(config=None, **options):
+    """Private copy of the options for one object, or the defaults if none are given.  Models add the settings of
+    their generator to it, which must not change the options of the caller or of other instances.
+    """
+    return argparse.Namespace(**dict(vars(config if config is not None else configure()), **options))
 
 # Scientific & Imaging Libraries
 import numpy as np
-import scipy.ndimage, scipy.misc, PIL.Image
-
-# Numeric Computing (GPU)
-import theano, theano.tensor as T
-T.nnet.softminus = lambda x: x - T.nnet.softplus(x)
+import scipy.ndimage, scipy.misc, PIL.Image, PIL.ImageFilter
 
 # Support ansi colors in Windows too.
 if sys.platform == 'win32':
     import colorama
 
-# Deep Learning Framework
-import lasagne
-from lasagne.layers import Conv2DLayer as ConvLayer, Deconv2DLayer as DeconvLayer, Pool2DLayer as PoolLayer
-from lasagne.layers import InputLayer, ConcatLayer, ElemwiseSumLayer, batch_norm
+# Numeric Computing (GPU) & Deep Learning Framework, loaded on first use by `load_backend()`.
+theano, T, lasagne = None, None, None
 
-print('{}  - Using the device `{}` for neural computation.{}\n'.format(ansi.CYAN, theano.config.device, ansi.ENDC))
+def load_backend(device):
+    """Import the underlying deep learning libraries based on the device specified, only once a model is built as it
+    takes seconds, so the first model decides the device for the process.  If you specify THEANO_FLAGS manually, the
+    code assumes you know what you are doing and they are not overriden!
+    """
+    global theano, T, lasagne, ConvLayer, DeconvLayer, PoolLayer, InputLayer, ConcatLayer, ElemwiseSumLayer
+    global batch_norm, SubpixelReshuffleLayer
+    if lasagne is not None: return
+
+    os.environ.setdefault('THEANO_FLAGS', 'floatX=float32,device={},force_device=True,allow_gc=True,'\
+                                          'print_active_device=False'.format(device))
+    import theano, theano.tensor as T
+    T.nnet.softminus = lambda x: x - T.nnet.softplus(x)
+
+    import lasagne
+    from lasagne.layers import Conv2DLayer as ConvLayer, Deconv2DLayer as DeconvLayer, Pool2DLayer as PoolLayer
+    from lasagne.layers import InputLayer, ConcatLayer, ElemwiseSumLayer, batch_norm
+
+    class SubpixelReshuffleLayer(lasagne.layers.Layer):
+        """Based on the code by ajbrock: https://github.com/ajbrock/Neural-Photo-Editor/
+        """
+
+        def __init__(self, incoming, channels, upscale, **kwargs):
+            super(SubpixelReshuffleLayer, self).__init__(incoming, **kwargs)
+            self.upscale = upscale
+            self.channels = channels
+
+        def get_output_shape_for(self, input_shape):
+            def up(d): return self.upscale * d if d else d
+            return (input_shape[0], self.channels, up(input_shape[2]), up(input_shape[3]))
+
+        def get_output_for(self, input, deterministic=False, **kwargs):
+            out, r = T.zeros(self.get_output_shape_for(input.shape)), self.upscale
+            for y, x in itertools.product(range(r), repeat=2):
+                out=T.inc_subtensor(out[:,:,y::r,x::r], input[:,r*y+x::r*r,:,:])
+            return out
+
+    print('{}  - Using the device `{}` for neural computation.{}\n'.format(ansi.CYAN, theano.config.device, ansi.ENDC))
 
 
 #======================================================================================================================
 # Image Processing
 #======================================================================================================================
+def open_training_image(args, filename):
+    """Open an image for training, downscaled randomly as specified, raising an exception if it's unsuitable.
+    """
+    orig = PIL.Image.open(filename).convert('RGB')
+    scale = 2 ** random.randint(0, args.train_scales)
+    if scale > 1 and all(s//scale >= args.batch_shape for s in orig.size):
+        orig = orig.resize((orig.size[0]//scale, orig.size[1]//scale), resample=PIL.Image.LANCZOS)
+    if any(s < args.batch_shape for s in orig.size):
+        raise ValueError('Image is too small for training with size {}'.format(orig.size))
+    return orig
+
+def degrade_training_image(args, orig):
+    """Create the seed image for the generator by applying the blur, downscale and JPEG artifacts as specified.
+    """
+    seed = orig
+    if args.train_blur is not None:
+        seed = seed.filter(PIL.ImageFilter.GaussianBlur(radius=random.randint(0, args.train_blur*2)))
+    if args.zoom > 1:
+        resample = PIL.Image.LANCZOS if args.train_resample == 'lanczos' else PIL.Image.BOX
+        seed = seed.resize((orig.size[0]//args.zoom, orig.size[1]//args.zoom), resample=resample)
+    if len(args.train_jpeg) > 0:
+        buffer, rng = io.BytesIO(), args.train_jpeg[-1] if len(args.train_jpeg) > 1 else 15
+        seed.save(buffer, format='jpeg', quality=args.train_jpeg[0]+random.randrange(-rng, +rng))
+        seed = PIL.Image.open(buffer)
+    return seed
+
+def load_training_image(args, filename):
+    """Open an image for training and create its degraded version used as the seed, both as float32 arrays.
+    """
+    orig = open_training_image(args, filename)
+    seed = degrade_training_image(args, orig)
+    orig = scipy.misc.fromimage(orig).astype(np.float32)
+    seed = scipy.misc.fromimage(seed).astype(np.float32)
+
+    if args.train_noise is not None:
+        seed += scipy.random.normal(scale=args.train_noise, size=(seed.shape[0], seed.shape[1], 1))
+    return orig, seed
+
+def random_positions(args, height, width):
+    """Pick random coordinates of fragments within a seed image of given size, as many as the buffer fraction allows.
+    """
+    seed_shape = args.batch_shape // args.zoom
+    for _ in range(height * width // (args.buffer_fraction * seed_shape ** 2)):
+        yield random.randint(0, height - seed_shape), random.randint(0, width - seed_shape)
+
+def random_fragments(args, orig, seed):
+    """Pick random fragments from the loaded image, yielding them in NCHW layout normalized for the network.
+    """
+    seed_shape, orig_shape = args.batch_shape // args.zoom, args.batch_shape
+    for h, w in random_positions(args, seed.shape[0], seed.shape[1]):
+        seed_chunk = seed[h:h+seed_shape, w:w+seed_shape]
+        h, w = h * args.zoom, w * args.zoom
+        orig_chunk = orig[h:h+orig_shape, w:w+orig_shape]
+        yield (np.transpose(orig_chunk.astype(np.float32) / 255.0 - 0.5, (2, 0, 1)),
+               np.transpose(seed_chunk.astype(np.float32) / 255.0 - 0.5, (2, 0, 1)))
+
+def resample_matrix(size, zoom, method):
+    """Matrix that downscales `size` pixels by `zoom` when multiplied, either averaging areas or with a Lanczos filter
+    widened to avoid aliasing.  Weights are computed the same way as PIL, normalized within the image bounds.
+    """
+    matrix = np.zeros((size // zoom, size), dtype=np.float32)
+    for i in range(size // zoom):
+        if method == 'area':
+            matrix[i, i*zoom:(i+1)*zoom] = 1.0 / zoom
+            continue
+        center = (i + 0.5) * zoom
+        taps = np.arange(max(0, int(center - 3 * zoom)), min(size, int(math.ceil(center + 3 * zoom))))
+        d = (taps + 0.5 - center) / zoom
+        weights = np.where(np.abs(d) < 3.0, np.sinc(d) * np.sinc(d / 3.0), 0.0)
+        matrix[i, taps] = weights / weights.sum()
+    return matrix
+
+
+class FragmentDegrader(object):
+    """Same degradation as `degrade_training_image`, but applied to a stack of clean fragments at once with NumPy:
+    blurring fragments in groups with the same radius, downscaling with matrix products and adding noise, so only the
+    JPEG compression runs per fragment, in a pool of threads.  Results are normalized straight into the buffers.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.orig_shape, self.seed_shape = args.batch_shape, args.batch_shape // args.zoom
+        self.matrix = resample_matrix(self.orig_shape, args.zoom, args.train_resample)
+        self.pool = concurrent.futures.ThreadPoolExecutor() if len(args.train_jpeg) > 0 else None
+
+    def crop(self, filename):
+        orig, z, s = np.asarray(open_training_image(self.args, filename)), self.args.zoom, self.orig_shape
+        positions = list(random_positions(self.args, orig.shape[0] // z, orig.shape[1] // z))
+        return np.stack([orig[y*z:y*z+s, x*z:x*z+s] for y, x in positions]) if positions else None
+
+    def compress(self, seed):
+        rng = self.args.train_jpeg[-1] if len(self.args.train_jpeg) > 1 else 15
+        image = PIL.Image.fromarray(seed.transpose(1, 2, 0).round().clip(0.0, 255.0).astype(np.uint8))
+        buffer = io.BytesIO()
+        image.save(buffer, format='jpeg', quality=self.args.train_jpeg[0]+random.randrange(-rng, +rng))
+        seed[:] = np.asarray(PIL.Image.open(buffer)).transpose(2, 0, 1)
+
+    def fragments(self, filename):
+        """Open an image then return its clean fragments as uint8 HWC, their degraded seeds as float NCHW in range
+        [0, 255], and the noise to add.
+        """
+        args = self.args
+        origs = self.crop(filename)
+        if origs is None: return []
+        images = origs.astype(np.float32).transpose(0, 3, 1, 2)
+
+        if args.train_blur is not None:
+            radius = np.random.randint(0, args.train_blur * 2 + 1, size=len(images))
+            for r in np.unique(radius[radius > 0]):
+                images[radius == r] = scipy.ndimage.gaussian_filter(images[radius == r], sigma=(0, 0, r, r))
+        seeds = np.matmul(np.matmul(self.matrix, images), self.matrix.T) if args.zoom > 1 else images
+        if self.pool is not None:
+            list(self.pool.map(self.compress, seeds))
+
+        shape = (len(seeds), 1, self.seed_shape, self.seed_shape)
+        noise = [0.0] * len(seeds)
+        if args.train_noise is not None:
+            noise = np.random.normal(scale=args.train_noise, size=shape).astype(np.float32)
+        return list(zip(origs, seeds, noise))
+
+    def write(self, orig_out, seed_out, orig, seed, noise):
+        np.multiply(orig.transpose(2, 0, 1), 1.0 / 255.0, out=orig_out)
+        orig_out -= 0.5
+        np.add(seed, noise, out=seed_out)
+        seed_out *= 1.0 / 255.0
+        seed_out -= 0.5
+
+
 class DataLoader(threading.Thread):
 
-    def __init__(self):
+    def __init__(self, args):
         super(DataLoader, self).__init__(daemon=True)
+        self.args = args
         self.data_ready = threading.Event()
         self.data_copied = threading.Event()
+        self.lock = threading.Lock()
 
         self.orig_shape, self.seed_shape = args.batch_shape, args.batch_shape // args.zoom
 
@@ -147,9 +369,12 @@ class DataLoader(threading.Thread):
         if len(self.files) == 0:
             error("There were no files found to train from searching for `{}`".format(args.train),
                   "  - Try putting all your images in one folder and using `--train=data/*.jpg`")
+        self.degrader = FragmentDegrader(args) if args.train_vectorize else None
 
         self.available = set(range(args.buffer_size))
         self.ready = set()
+        self.generation, self.sampled = [0] * args.buffer_size, []
+        self.produced, self.waited = 0, 0.0
 
         self.cwd = os.getcwd()
         self.start()
@@ -163,91 +388,487 @@ class DataLoader(threading.Thread):
     def add_to_buffer(self, f):
         filename = os.path.join(self.cwd, f)
         try:
-            orig = PIL.Image.open(filename).convert('RGB')
-            scale = 2 ** random.randint(0, args.train_scales)
-            if scale > 1 and all(s//scale >= args.batch_shape for s in orig.size):
-                orig = orig.resize((orig.size[0]//scale, orig.size[1]//scale), resample=PIL.Image.LANCZOS)
-            if any(s < args.batch_shape for s in orig.size):
-                raise ValueError('Image is too small for training with size {}'.format(orig.size))
+            if self.degrader is not None:
+                fragments = self.degrader.fragments(filename)
+            else:
+                fragments = random_fragments(self.args, *load_training_image(self.args, filename))
         except Exception as e:
             warn('Could not load `{}` as image.'.format(filename),
                  '  - Try fixing or removing the file before next run.')
             self.files.remove(f)
             return
 
-        seed = orig
-        if args.train_blur is not None:
-            seed = seed.filter(PIL.ImageFilter.GaussianBlur(radius=random.randint(0, args.train_blur*2)))
-        if args.zoom > 1:
-            seed = seed.resize((orig.size[0]//args.zoom, orig.size[1]//args.zoom), resample=PIL.Image.LANCZOS)
-        if len(args.train_jpeg) > 0:
-            buffer, rng = io.BytesIO(), args.train_jpeg[-1] if len(args.train_jpeg) > 1 else 15
-            seed.save(buffer, format='jpeg', quality=args.train_jpeg[0]+random.randrange(-rng, +rng))
-            seed = PIL.Image.open(buffer)
+        for fragment in fragments:
+            while True:
+                # Slots being overwritten are removed from the ready set so they can't be sampled meanwhile.
+                with self.lock:
+                    if len(self.available) > 0:
+                        i = self.available.pop()
+                        self.ready.discard(i)
+                        break
+                self.data_copied.wait()
+                self.data_copied.clear()
 
-        orig = scipy.misc.fromimage(orig).astype(np.float32)
-        seed = scipy.misc.fromimage(seed).astype(np.float32)
+            if self.degrader is not None:
+                self.degrader.write(self.orig_buffer[i], self.seed_buffer[i], *fragment)
+            else:
+                self.orig_buffer[i], self.seed_buffer[i] = fragment
+            with self.lock:
+                self.ready.add(i)
+                self.generation[i] += 1
+                self.produced += 1
+                if len(self.ready) >= self.args.batch_size:
+                    self.data_ready.set()
+
+    def status(self):
+        with self.lock:
+            return {'ready': len(self.ready), 'available': len(self.available), 'produced': self.produced}
 
-        if args.train_noise is not None:
-            seed += scipy.random.normal(scale=args.train_noise, size=(seed.shape[0], seed.shape[1], 1))
+    def copy(self, origs_out, seeds_out):
+        start = time.time()
+        self.data_ready.wait()
+        self.data_ready.clear()
+        self.waited = time.time() - start
+
+        with self.lock:
+            self.sampled = random.sample(sorted(self.ready), self.args.batch_size)
+            for i, j in enumerate(self.sampled):
+                origs_out[i] = self.orig_buffer[j]
+                seeds_out[i] = self.seed_buffer[j]
+                self.available.add(j)
+            # Identify fragments by slot and how often it was written, e.g. for caching features of real images.
+            self.sampled = [(j, self.generation[j]) for j in self.sampled]
+        self.data_copied.set()
 
-        for _ in range(seed.shape[0] * seed.shape[1] // (args.buffer_fraction * self.seed_shape ** 2)):
-            h = random.randint(0, seed.shape[0] - self.seed_shape)
-            w = random.randint(0, seed.shape[1] - self.seed_shape)
-            seed_chunk = seed[h:h+self.seed_shape, w:w+self.seed_shape]
-            h, w = h * args.zoom, w * args.zoom
-            orig_chunk = orig[h:h+self.orig_shape, w:w+self.orig_shape]
 
-            while len(self.available) == 0:
-                self.data_copied.wait()
-                self.data_copied.clear()
+def fill_shared_buffers(args, files, orig_memory, seed_memory, free, filled):
+    """Entry point of worker processes for `DataLoaderPool`, taking free slots of the ring buffer from one queue and
+    returning their indices through another once the fragment was written to shared memory.
+    """
+    random.seed()
+    np.random.seed()
+    orig_shape, seed_shape = args.batch_shape, args.batch_shape // args.zoom
+    orig_buffer = np.frombuffer(orig_memory, dtype=np.float32).reshape((-1, 3, orig_shape, orig_shape))
+    seed_buffer = np.frombuffer(seed_memory, dtype=np.float32).reshape((-1, 3, seed_shape, seed_shape))
+    degrader = FragmentDegrader(args) if args.train_vectorize else None
+
+    while len(files) > 0:
+        random.shuffle(files)
+        for f in list(files):
+            try:
+                if degrader is not None:
+                    fragments = degrader.fragments(f)
+                else:
+                    fragments = random_fragments(args, *load_training_image(args, f))
+            except Exception as e:
+                warn('Could not load `{}` as image.'.format(f),
+                     '  - Try fixing or removing the file before next run.')
+                files.remove(f)
+                continue
+
+            for fragment in fragments:
+                i = free.get()
+                if degrader is not None:
+                    degrader.write(orig_buffer[i], seed_buffer[i], *fragment)
+                else:
+                    orig_buffer[i], seed_buffer[i] = fragment
+                filled.put(i)
+
+
+class DataLoaderPool(object):
+    """Same interface as `DataLoader`, but decoding and degrading images in multiple worker processes that write into
+    a ring of slots in shared memory.  Slots that were sampled stay available for reuse in later batches until they
+    are the oldest, then they are recycled to the workers as needed to keep them busy.
+    """
 
-            i = self.available.pop()
-            self.orig_buffer[i] = np.transpose(orig_chunk.astype(np.float32) / 255.0 - 0.5, (2, 0, 1))
-            self.seed_buffer[i] = np.transpose(seed_chunk.astype(np.float32) / 255.0 - 0.5, (2, 0, 1))
-            self.ready.add(i)
+    def __init__(self, args):
+        self.args = args
+        self.orig_shape, self.seed_shape = args.batch_shape, args.batch_shape // args.zoom
+        self.files = glob.glob(args.train)
+        if len(self.files) == 0:
+            error("There were no files found to train from searching for `{}`".format(args.train),
+                  "  - Try putting all your images in one folder and using `--train=data/*.jpg`")
 
-            if len(self.ready) >= args.batch_size:
-                self.data_ready.set()
+        orig_memory = multiprocessing.RawArray('f', args.buffer_size * 3 * self.orig_shape ** 2)
+        seed_memory = multiprocessing.RawArray('f', args.buffer_size * 3 * self.seed_shape ** 2)
+        self.orig_buffer = np.frombuffer(orig_memory, dtype=np.float32).reshape((-1, 3) + (self.orig_shape,) * 2)
+        self.seed_buffer = np.frombuffer(seed_memory, dtype=np.float32).reshape((-1, 3) + (self.seed_shape,) * 2)
+
+        # Every slot is either with the workers (pending), or ready to be sampled.  Sampled ones are also tracked as
+        # used, oldest first, so they can be recycled.
+        self.free, self.filled = multiprocessing.Queue(), multiprocessing.Queue()
+        for i in range(args.buffer_size): self.free.put(i)
+        self.pending, self.ready, self.used = args.buffer_size, [], collections.OrderedDict()
+        self.generation, self.sampled = [0] * args.buffer_size, []
+        self.produced, self.waited = 0, 0.0
+
+        workers = min(args.buffer_workers, len(self.files))
+        self.workers = [multiprocessing.Process(target=fill_shared_buffers, daemon=True,
+                                                args=(args, self.files[k::workers], orig_memory, seed_memory,
+                                                      self.free, self.filled)) for k in range(workers)]
+        for w in self.workers: w.start()
+
+    def receive(self, block):
+        j = self.filled.get(block=block)
+        self.ready.append(j)
+        self.generation[j] += 1
+        self.pending -= 1
+        self.produced += 1
+
+    def status(self):
+        return {'ready': len(self.ready), 'available': self.pending, 'produced': self.produced}
 
     def copy(self, origs_out, seeds_out):
-        self.data_ready.wait()
-        self.data_ready.clear()
+        # Wait for at least one new fragment like the threaded loader, then take all others that are finished.
+        start = time.time()
+        self.receive(block=True)
+        while len(self.ready) < self.args.batch_size:
+            self.receive(block=True)
+        self.waited = time.time() - start
+        try:
+            while True: self.receive(block=False)
+        except queue.Empty:
+            pass
 
-        for i, j in enumerate(random.sample(self.ready, args.batch_size)):
+        self.sampled = random.sample(self.ready, self.args.batch_size)
+        for i, j in enumerate(self.sampled):
             origs_out[i] = self.orig_buffer[j]
             seeds_out[i] = self.seed_buffer[j]
-            self.available.add(j)
-        self.data_copied.set()
+            self.used.setdefault(j, None)
+        self.sampled = [(j, self.generation[j]) for j in self.sampled]
 
+        while self.pending < 2 * len(self.workers) and len(self.used) > 0:
+            j, _ = self.used.popitem(last=False)
+            self.ready.remove(j)
+            self.free.put(j)
+            self.pending += 1
 
-#======================================================================================================================
-# Convolution Networks
-#======================================================================================================================
 
-class SubpixelReshuffleLayer(lasagne.layers.Layer):
-    """Based on the code by ajbrock: https://github.com/ajbrock/Neural-Photo-Editor/
+def prepare_fragments(args, directory, shard_size=1024):
+    """Extract pairs of original and seed fragments from all the training images once, applying the same degradations
+    with multiple random variants per fragment.  They are stored as shards of uint8 arrays along with an index file,
+    so training can sample batches from them without decoding any images.  Noise is added later when sampling.
+    """
+    files = glob.glob(args.train)
+    if len(files) == 0:
+        error("There were no files found to prepare from searching for `{}`".format(args.train))
+    os.makedirs(directory, exist_ok=True)
+
+    orig_shape, seed_shape = args.batch_shape, args.batch_shape // args.zoom
+    shards, origs, seeds = [], [], []
+    def flush():
+        if len(origs) == 0: return
+        names = ('origs-%05i.npy' % len(shards), 'seeds-%05i.npy' % len(shards))
+        np.save(os.path.join(directory, names[0]), np.stack(origs))
+        np.save(os.path.join(directory, names[1]), np.stack(seeds))
+        shards.append({'origs': names[0], 'seeds': names[1], 'count': len(origs)})
+        del origs[:], seeds[:]
+
+    for i, f in enumerate(files):
+        try:
+            orig = open_training_image(args, f)
+        except Exception as e:
+            warn('Could not load `{}` as image.'.format(f), '  - Skipping this file, try fixing or removing it.')
+            continue
+        variants = [np.asarray(degrade_training_image(args, orig).convert('RGB')) for _ in range(args.train_variants)]
+        orig = np.asarray(orig)
+
+        for h, w in random_positions(args, variants[0].shape[0], variants[0].shape[1]):
+            seeds.append(np.stack([v[h:h+seed_shape,w:w+seed_shape].transpose((2, 0, 1)) for v in variants]))
+            h, w = h * args.zoom, w * args.zoom
+            origs.append(orig[h:h+orig_shape,w:w+orig_shape].transpose((2, 0, 1)))
+            if len(origs) == shard_size: flush()
+        print('\r  - Extracted fragments from {}/{} images.'.format(i+1, len(files)), end='', flush=True)
+    flush()
+
+    index = {'orig_shape': orig_shape, 'seed_shape': seed_shape, 'variants': args.train_variants, 'shards': shards}
+    json.dump(index, open(os.path.join(directory, 'fragments.json'), 'w'), indent=2)
+    print('\n  - Stored {} fragments in `{}`.'.format(sum(s['count'] for s in shards), directory))
+
+
+class FragmentStore(object):
+    """Same interface as `DataLoader`, but sampling batches from fragments prepared on disk with `--train-prepare`.
+    Shards are memory-mapped and a batch is gathered with fancy indexing, so no images are decoded while training.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        index = json.load(open(os.path.join(args.train, 'fragments.json')))
+        if (index['orig_shape'], index['seed_shape']) != (args.batch_shape, args.batch_shape // args.zoom):
+            error("Fragments in `{}` were prepared with a different shape or zoom.".format(args.train),
+                  "  - Use `--batch-shape={}` or prepare them again.".format(index['orig_shape']))
+
+        self.origs = [np.load(os.path.join(args.train, s['origs']), mmap_mode='r') for s in index['shards']]
+        self.seeds = [np.load(os.path.join(args.train, s['seeds']), mmap_mode='r') for s in index['shards']]
+        self.offsets = np.cumsum([0] + [s['count'] for s in index['shards']])
+        self.variants = index['variants']
+        self.produced, self.waited = 0, 0.0
+        print('  - Sampling from {} fragments stored in `{}`.'.format(self.offsets[-1], args.train))
+
+    def status(self):
+        return {'ready': int(self.offsets[-1]), 'available': 0, 'produced': self.produced}
+
+    def copy(self, origs_out, seeds_out):
+        args = self.args
+        self.produced += args.batch_size
+        total = self.offsets[-1]
+        indices = np.sort(np.random.choice(total, args.batch_size, replace=total < args.batch_size))
+        shards = np.searchsorted(self.offsets, indices, side='right') - 1
+        self.sampled = list(indices)
+
+        i = 0
+        for k in np.unique(shards):
+            local = indices[shards == k] - self.offsets[k]
+            origs_out[i:i+len(local)] = self.origs[k][local]
+            seeds_out[i:i+len(local)] = self.seeds[k][local, np.random.randint(0, self.variants, size=len(local))]
+            i += len(local)
+
+        if args.train_noise is not None:
+            seeds_out += np.random.normal(scale=args.train_noise, size=(seeds_out.shape[0], 1) + seeds_out.shape[2:])
+        for array in (origs_out, seeds_out):
+            array /= 255.0
+            array -= 0.5
+
+
+def imread_rows(filename):
+    """Open an image so its rows can be indexed lazily, memory-mapping raw `.npy` arrays and otherwise decoding the
+    file once as compact uint8 rather than as a full-size floating point array.
+    """
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r')
+    # Streamed images may exceed the decompression bomb limit of Pillow, which is only lifted while opening this one.
+    limit, PIL.Image.MAX_IMAGE_PIXELS = PIL.Image.MAX_IMAGE_PIXELS, None
+    try:
+        image = PIL.Image.open(filename)
+    finally:
+        PIL.Image.MAX_IMAGE_PIXELS = limit
+    return np.asarray(image.convert('RGB'))
+
+def reflect_indices(indices, size):
+    """Map coordinates outside of the range [0, size) back inside, as `np.pad(mode='reflect')` does.
+    """
+    indices = np.abs(indices)
+    return np.where(indices >= size, 2 * (size - 1) - indices, indices).clip(0, size - 1)
+
+
+def color_histograms(image, rows=256):
+    """Count the occurrences of every value in each channel of a uint8 RGB image, a band of rows at a time.
+    """
+    counts = np.zeros((3, 256), dtype=np.int64)
+    for y in range(0, image.shape[0], rows):
+        band = np.asarray(image[y:y+rows], dtype=np.uint8)
+        for i in range(3): counts[i] += np.bincount(band[:,:,i].ravel(), minlength=256)
+    return counts
+
+def histogram_tables(source, target):
+    """Lookup tables for each channel that remap uint8 values so the source histogram matches the target, by
+    aligning their cumulative distributions.
+    """
+    tables = np.zeros((3, 256), dtype=np.uint8)
+    for i in range(3):
+        values = np.nonzero(target[i])[0]
+        quantiles = np.cumsum(target[i][values]) / max(1, target[i].sum())
+        tables[i] = np.interp(np.cumsum(source[i]) / max(1, source[i].sum()), quantiles, values).round()
+    return tables
+
+def apply_tables(image, tables, rows=256):
+    """Remap the channels of a uint8 RGB image in place through lookup tables, a band of rows at a time.
+    """
+    for y in range(0, image.shape[0], rows):
+        band = image[y:y+rows]
+        for i in range(3): band[:,:,i] = tables[i][band[:,:,i]]
+    return image
+
+
+class PNGWriter(object):
+    """Encode an RGB image into a PNG file incrementally, a band of rows at a time, using the `Sub` filter.
+    """
+    extension = '.png'
+
+    def __init__(self, filename, width, height):
+        self.file = open(filename, 'wb')
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def chunk(self, tag, data):
+        self.file.write(struct.pack('>I', len(data)) + tag + data)
+        self.file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    def write(self, rows):
+        data = np.empty((rows.shape[0], 1 + rows.shape[1] * 3), dtype=np.uint8)
+        data[:,0] = 1
+        data[:,1:4] = rows[:,0]
+        data[:,4:] = rows[:,1:].reshape(rows.shape[0], -1) - rows[:,:-1].reshape(rows.shape[0], -1)
+        compressed = self.compressor.compress(data.tobytes())
+        if compressed: self.chunk(b'IDAT', compressed)
+
+    def close(self):
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        self.file.close()
+
+
+class NPYWriter(object):
+    """Store an RGB image as a memory-mapped uint8 `.npy` array, filled in a band of rows at a time.
+    """
+    extension = '.npy'
+
+    def __init__(self, filename, width, height):
+        self.array = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+        self.row = 0
+
+    def write(self, rows):
+        self.array[self.row:self.row+rows.shape[0]] = rows
+        self.row += rows.shape[0]
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+
+def probe_video(filename):
+    """Query the width, height and frame rate of the first video stream in a file using `ffprobe`.
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-of', 'json',
+               '-show_entries', 'stream=width,height,r_frame_rate', filename]
+    streams = json.loads(subprocess.check_output(command).decode('utf-8')).get('streams', [])
+    if len(streams) == 0:
+        error("Could not find a video stream in file `{}`.".format(filename))
+    return streams[0]['width'], streams[0]['height'], streams[0]['r_frame_rate']
+
+def read_frames(source):
+    """Iterate over the frames of a video as names and RGB arrays, either decoded by an `ffmpeg` process through a
+    pipe, or loaded from the images in a folder sorted by filename.
     """
+    if os.path.isdir(source):
+        for filename in sorted(glob.glob(os.path.join(source, '*'))):
+            if os.path.splitext(filename)[1].lower() not in ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff'):
+                continue
+            yield os.path.basename(filename), scipy.ndimage.imread(filename, mode='RGB')
+        return
+
+    width, height, _ = probe_video(source)
+    command = ['ffmpeg', '-v', 'error', '-i', source, '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        for i in itertools.count():
+            data = process.stdout.read(width * height * 3)
+            if len(data) < width * height * 3: break
+            yield 'frame_%05i.png' % i, np.frombuffer(data, dtype=np.uint8).reshape((height, width, 3))
+
+class VideoWriter(object):
+    """Output frames either piped into an `ffmpeg` process encoding a video at the same frame rate as the source,
+    including its audio, or saved as PNG images into a folder.
+    """
+
+    def __init__(self, target, source, width, height):
+        self.target, self.process = target, None
+        if os.path.isdir(source):
+            os.makedirs(target, exist_ok=True)
+            return
+
+        _, _, rate = probe_video(source)
+        command = ['ffmpeg', '-v', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '%ix%i' % (width, height), '-r', rate, '-i', '-', '-i', source,
+                   '-map', '0:v', '-map', '1:a?', '-c:a', 'copy', '-pix_fmt', 'yuv420p', target]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, name, frame):
+        if self.process is None:
+            PIL.Image.fromarray(frame).save(os.path.join(self.target, os.path.splitext(name)[0] + '.png'))
+        else:
+            self.process.stdin.write(frame.tobytes())
 
-    def __init__(self, incoming, channels, upscale, **kwargs):
-        super(SubpixelReshuffleLayer, self).__init__(incoming, **kwargs)
-        self.upscale = upscale
-        self.channels = channels
+    def close(self):
+        if self.process is None: return
+        self.process.stdin.close()
+        self.process.wait()
 
-    def get_output_shape_for(self, input_shape):
-        def up(d): return self.upscale * d if d else d
-        return (input_shape[0], self.channels, up(input_shape[2]), up(input_shape[3]))
 
-    def get_output_for(self, input, deterministic=False, **kwargs):
-        out, r = T.zeros(self.get_output_shape_for(input.shape)), self.upscale
-        for y, x in itertools.product(range(r), repeat=2):
-            out=T.inc_subtensor(out[:,:,y::r,x::r], input[:,r*y+x::r*r,:,:])
-        return out
+#======================================================================================================================
+# Model Files
+#======================================================================================================================
 
+WEIGHTS_MAGIC, WEIGHTS_ALIGN = b'\x93NEWGHT', 64
+
+def save_weights(filename, config, layers):
+    """Store parameters uncompressed, behind a JSON header listing the layer name, shape, dtype and offset of every
+    array.  Arrays are aligned so they can be memory-mapped directly, and nothing is unpickled when loading.
+    """
+    entries, offset = [], 0
+    for name, arrays in layers.items():
+        for a in arrays:
+            entries.append({'layer': name, 'shape': list(a.shape), 'dtype': a.dtype.name, 'offset': offset})
+            offset += -(-a.nbytes // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+
+    header = json.dumps({'config': config, 'arrays': entries}).encode('utf-8')
+    start = -(-(len(WEIGHTS_MAGIC) + 4 + len(header)) // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(WEIGHTS_MAGIC + struct.pack('<I', len(header)) + header)
+        for e, a in zip(entries, itertools.chain(*layers.values())):
+            f.seek(start + e['offset'])
+            f.write(np.ascontiguousarray(a).tobytes())
+        f.truncate(start + offset)
+    os.replace(filename + '.tmp', filename)
+
+def load_weights(filename):
+    """Memory-map a file stored by `save_weights`, returning the config and read-only views of all the arrays.
+    """
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    if bytes(data[:len(WEIGHTS_MAGIC)]) != WEIGHTS_MAGIC:
+        error("File `{}` is not in the expected format for model weights.".format(filename))
+    size = struct.unpack('<I', bytes(data[len(WEIGHTS_MAGIC):len(WEIGHTS_MAGIC)+4]))[0]
+    header = json.loads(bytes(data[len(WEIGHTS_MAGIC)+4:len(WEIGHTS_MAGIC)+4+size]).decode('utf-8'))
+    start = -(-(len(WEIGHTS_MAGIC) + 4 + size) // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+
+    layers = collections.OrderedDict()
+    for e in header['arrays']:
+        dtype, count = np.dtype(e['dtype']), int(np.prod(e['shape']))
+        view = data[start+e['offset']:start+e['offset']+count*dtype.itemsize].view(dtype).reshape(e['shape'])
+        layers.setdefault(e['layer'], []).append(view)
+    return header['config'], layers
+
+def convert_weights(filename):
+    """Convert a bz2-compressed pickle of model parameters into the memory-mappable format, reporting how long each
+    takes to load.  Generator files store `(config, params)`, while the VGG19 file is a list of arrays.
+    """
+    start = time.time()
+    data = pickle.load(bz2.open(filename, 'rb'))
+    elapsed = time.time() - start
+
+    config, layers = data if isinstance(data, tuple) else ({}, {'params': data})
+    layers = collections.OrderedDict((k, [np.asarray(a, dtype=np.float32) for a in v]) for k, v in layers.items())
+    output = filename.replace('.pkl.bz2', '') + '.weights'
+    save_weights(output, config, layers)
+
+    start = time.time()
+    _, arrays = load_weights(output)
+    for a in itertools.chain(*arrays.values()): a.sum()     # Read all pages so timing includes disk access.
+    print('  - Converted `{}` to `{}`, loading took {:4.2f}s and now {:4.3f}s.'\
+          .format(filename, output, elapsed, time.time() - start))
+
+def fresh_weights(filename):
+    """Name of the memory-mappable version of a `.pkl.bz2` file if it exists and is at least as recent, otherwise
+    `None` so the compressed file is loaded.  Converted files become stale when a model is trained again.
+    """
+    weights = filename.replace('.pkl.bz2', '.weights')
+    if not os.path.exists(weights): return None
+    if os.path.exists(filename) and os.path.getmtime(weights) < os.path.getmtime(filename):
+        warn("Ignoring `{}` as it's older than `{}`, run `--convert` again.".format(os.path.basename(weights),
+                                                                                  os.path.basename(filename)))
+        return None
+    return weights
+
+
+#======================================================================================================================
+# Convolution Networks
+#======================================================================================================================
 
 class Model(object):
 
-    def __init__(self):
+    def __init__(self, config=None):
+        self.args = copy_config(config)
+        load_backend(self.args.device)
         self.network = collections.OrderedDict()
         self.network['img'] = InputLayer((None, 3, None, None))
         self.network['seed'] = InputLayer((None, 3, None, None))
@@ -255,9 +876,9 @@ class Model(object):
         config, params = self.load_model()
         self.setup_generator(self.last_layer(), config)
 
-        if args.train:
-            concatenated = lasagne.layers.ConcatLayer([self.network['img'], self.network['out']], axis=0)
-            self.setup_perceptual(concatenated)
+        if self.args.train:
+            self.concatenated = lasagne.layers.ConcatLayer([self.network['img'], self.network['out']], axis=0)
+            self.setup_perceptual(self.concatenated)
             self.load_perceptual()
             self.setup_discriminator()
         self.load_generator(params)
@@ -280,10 +901,11 @@ class Model(object):
     def make_block(self, name, input, units):
         self.make_layer(name+'-A', input, units, alpha=0.1)
         # self.make_layer(name+'-B', self.last_layer(), units, alpha=1.0)
-        return ElemwiseSumLayer([input, self.last_layer()]) if args.generator_residual else self.last_layer()
+        return ElemwiseSumLayer([input, self.last_layer()]) if self.args.generator_residual else self.last_layer()
 
     def setup_generator(self, input, config):
-        for k, v in config.items(): setattr(args, k, v)
+        args = self.args
+        for k, v in config.items(): setattr(self.args, k, v)
         args.zoom = 2**(args.generator_upscale - args.generator_downscale)
 
         units_iter = extend(args.generator_filters)
@@ -304,6 +926,31 @@ class Model(object):
 
         self.network['out'] = ConvLayer(self.last_layer(), 3, filter_size=(7,7), pad=(3,3), nonlinearity=None)
 
+    def receptive_field(self):
+        """Number of input pixels on each side of a tile that can influence its output, derived from the filter sizes
+        and strides of the generator as configured.  Overlapping tiles by this much renders them without seams.
+        """
+        args = self.args
+        radius, step = 3.0, 1.0                         # Input convolution is 7x7.
+        for _ in range(args.generator_downscale):
+            radius += 2.0 * step; step *= 2.0           # Strided 4x4 convolution, asymmetric so rounded up.
+        radius += args.generator_blocks * step          # Each residual block has one 3x3 convolution.
+        for _ in range(args.generator_upscale):
+            radius += step; step /= 2.0                 # Convolution 3x3 followed by sub-pixel reshuffle.
+        radius += 3.0 * step                            # Output convolution is 7x7.
+
+        align = 2 ** args.generator_downscale
+        return int(math.ceil(radius / align)) * align
+
+    def estimate_memory(self, size):
+        """Approximate number of bytes of activations the generator needs to render one square tile of given size,
+        based on the largest pair of consecutive layers that must be kept in memory at the same time.
+        """
+        layers = lasagne.layers.get_all_layers(self.network['out'], treat_as_input=[self.network['seed']])
+        shapes = lasagne.layers.get_output_shape(layers, {self.network['seed']: (1, 3, size, size)})
+        counts = [int(np.prod(s)) for s in shapes]
+        return 4 * max(a + b for a, b in zip(counts, counts[1:]))
+
     def setup_perceptual(self, input):
         """Use lasagne to create a network of convolution layers using pre-trained VGG19 weights.
         """
@@ -333,7 +980,7 @@ class Model(object):
         self.network['conv5_4'] = ConvLayer(self.network['conv5_3'], 512, 3, pad=1)
 
     def setup_discriminator(self):
-        c = args.discriminator_size
+        c = self.args.discriminator_size
         self.make_layer('disc1.1', batch_norm(self.network['conv1_2']), 1*c, filter_size=(5,5), stride=(2,2), pad=(2,2))
         self.make_layer('disc1.2', self.last_layer(), 1*c, filter_size=(5,5), stride=(2,2), pad=(2,2))
         self.make_layer('disc2', batch_norm(self.network['conv2_2']), 2*c, filter_size=(5,5), stride=(2,2), pad=(2,2))
@@ -354,13 +1001,17 @@ class Model(object):
         """Open the serialized parameters from a pre-trained network, and load them into the model created.
         """
         vgg19_file = os.path.join(os.path.dirname(__file__), 'vgg19_conv.pkl.bz2')
-        if not os.path.exists(vgg19_file):
+        vgg19_weights = fresh_weights(vgg19_file)
+        if vgg19_weights is not None:
+            data = load_weights(vgg19_weights)[1]['params']
+        elif os.path.exists(vgg19_file):
+            data = pickle.load(bz2.open(vgg19_file, 'rb'))
+        else:
             error("Model file with pre-trained convolution layers not found. Download here...",
                   "https://github.com/alexjc/neural-doodle/releases/download/v0.0/vgg19_conv.pkl.bz2")
-
-        data = pickle.load(bz2.open(vgg19_file, 'rb'))
         layers = lasagne.layers.get_all_layers(self.last_layer(), treat_as_input=[self.network['percept']])
-        for p, d in zip(itertools.chain(*[l.get_params() for l in layers]), data): p.set_value(d)
+        self.perceptual_params = list(itertools.chain(*[l.get_params() for l in layers]))
+        for p, d in zip(self.perceptual_params, data): p.set_value(d)
 
     def list_generator_layers(self):
         for l in lasagne.layers.get_all_layers(self.network['out'], treat_as_input=[self.network['img']]):
@@ -368,26 +1019,87 @@ class Model(object):
             name = list(self.network.keys())[list(self.network.values()).index(l)]
             yield (name, l)
 
-    def get_filename(self, absolute=False):
-        filename = 'ne%ix-%s-%s-%s.pkl.bz2' % (args.zoom, args.type, args.model, __version__)
+    def get_filename(self, absolute=False, extension='pkl.bz2'):
+        filename = 'ne%ix-%s-%s-%s.%s' % (self.args.zoom, self.args.type, self.args.model, __version__, extension)
         return os.path.join(os.path.dirname(__file__), filename) if absolute else filename
 
-    def save_generator(self):
+    def save_generator(self, writer=None):
+        """Snapshot the parameters of the generator, then compress them to disk either directly or from a background
+        writer.  The file is replaced atomically, so an interrupted save never leaves a broken model behind.  If the
+        model was converted, the memory-mappable file is written again afterwards so it's not stale.
+        """
         def cast(p): return p.get_value().astype(np.float16)
         params = {k: [cast(p) for p in l.get_params()] for (k, l) in self.list_generator_layers()}
-        config = {k: getattr(args, k) for k in ['generator_blocks', 'generator_residual', 'generator_filters'] + \
+        config = {k: getattr(self.args, k) for k in ['generator_blocks', 'generator_residual', 'generator_filters'] + \
                                                ['generator_upscale', 'generator_downscale']}
-        
-        pickle.dump((config, params), bz2.open(self.get_filename(absolute=True), 'wb'))
-        print('  - Saved model as `{}` after training.'.format(self.get_filename()))
+
+        def dump(filename=self.get_filename(absolute=True)):
+            with bz2.open(filename + '.tmp', 'wb') as f:
+                pickle.dump((config, params), f)
+            os.replace(filename + '.tmp', filename)
+            if os.path.exists(filename.replace('.pkl.bz2', '.weights')):
+                layers = collections.OrderedDict((k, [a.astype(np.float32) for a in v]) for k, v in params.items())
+                save_weights(filename.replace('.pkl.bz2', '.weights'), config, layers)
+            print('  - Saved model as `{}` after training.'.format(os.path.basename(filename)))
+        writer.submit(dump) if writer else dump()
+
+    def state_variables(self):
+        """All the shared variables that change during training: parameters of the generator and discriminator, batch
+        normalization statistics and optimizer moments, excluding VGG layers which stay fixed.
+        """
+        params = lasagne.layers.get_all_params([self.network['out'], self.network['disc']])
+        fixed = set(self.perceptual_params)
+        variables = [p for p in params if p not in fixed] + list(itertools.chain(*[u.keys() for u in self.updates]))
+        return list(collections.OrderedDict((v, None) for v in variables).keys())
+
+    def save_checkpoint(self, writer, epoch):
+        """Snapshot the whole training state and store it from the background writer, keeping the last few files.
+        """
+        values = [v.get_value() for v in self.state_variables()]
+        config = {'epoch': epoch, 'adversary_weight': float(self.adversary_weight.get_value())}
+        filename = self.get_filename(absolute=True, extension='%04i.ckpt' % epoch)
+
+        def dump():
+            save_weights(filename, config, {'state': values})
+            for old in sorted(glob.glob(self.get_filename(absolute=True, extension='*.ckpt')))[:-self.args.save_keep]:
+                os.remove(old)
+        writer.submit(dump)
+
+    def load_checkpoint(self):
+        """Restore the training state from the most recent checkpoint, returning the epoch where to continue.
+        """
+        checkpoints = sorted(glob.glob(self.get_filename(absolute=True, extension='*.ckpt')))
+        if len(checkpoints) == 0:
+            warn("No checkpoint found to resume training from, starting from the beginning.")
+            return 0
+
+        config, arrays = load_weights(checkpoints[-1])
+        variables = self.state_variables()
+        if [v.get_value().shape for v in variables] != [a.shape for a in arrays['state']]:
+            error("Checkpoint `{}` doesn't match the model configuration.".format(os.path.basename(checkpoints[-1])))
+        for v, a in zip(variables, arrays['state']): v.set_value(np.array(a))
+        self.adversary_weight.set_value(config['adversary_weight'])
+        print('  - Resuming training from checkpoint `{}`.'.format(os.path.basename(checkpoints[-1])))
+        return config['epoch'] + 1
 
     def load_model(self):
+        start, weights = time.time(), fresh_weights(self.get_filename(absolute=True))
+        if weights is not None:
+            config, params = load_weights(weights)
+            print('  - Mapped file `{}` with trained model in {:4.3f}s.'\
+                  .format(self.get_filename(extension='weights'), time.time() - start))
+            return config, params
+
         if not os.path.exists(self.get_filename(absolute=True)):
-            if args.train: return {}, {}
+            if self.args.train: return {}, {}
+            if self.args.benchmark:
+                warn("Model file `{}` not found, benchmarking a random generator.".format(self.get_filename()))
+                return {}, {}
             error("Model file with pre-trained convolution layers not found. Download it here...",
                   "https://github.com/alexjc/neural-enhance/releases/download/v%s/%s"%(__version__, self.get_filename()))
-        print('  - Loaded file `{}` with trained model.'.format(self.get_filename()))
-        return pickle.load(bz2.open(self.get_filename(absolute=True), 'rb'))
+        data = pickle.load(bz2.open(self.get_filename(absolute=True), 'rb'))
+        print('  - Loaded file `{}` with trained model in {:4.2f}s.'.format(self.get_filename(), time.time() - start))
+        return data
 
     def load_generator(self, params):
         if len(params) == 0: return
@@ -396,25 +1108,29 @@ class Model(object):
             assert len(l.get_params()) == len(params[k]), "Mismatch in types of layers."
             for p, v in zip(l.get_params(), params[k]):
                 assert v.shape == p.get_value().shape, "Mismatch in number of parameters for layer {}.".format(k)
-                p.set_value(v.astype(np.float32))
+                p.set_value(np.asarray(v, dtype=np.float32))
 
     #------------------------------------------------------------------------------------------------------------------
     # Training & Loss Functions
     #------------------------------------------------------------------------------------------------------------------
 
     def loss_perceptual(self, p):
-        return lasagne.objectives.squared_error(p[:args.batch_size], p[args.batch_size:]).mean()
+        return lasagne.objectives.squared_error(p[:self.args.batch_size], p[self.args.batch_size:]).mean()
+
+    def loss_pixel(self, x, y):
+        return lasagne.objectives.squared_error(x, y).mean()
 
     def loss_total_variation(self, x):
         return T.mean(((x[:,:,:-1,:-1] - x[:,:,1:,:-1])**2 + (x[:,:,:-1,:-1] - x[:,:,:-1,1:])**2)**1.25)
 
     def loss_adversarial(self, d):
-        return T.mean(1.0 - T.nnet.softminus(d[args.batch_size:]))
+        return T.mean(1.0 - T.nnet.softminus(d[self.args.batch_size:]))
 
     def loss_discriminator(self, d):
-        return T.mean(T.nnet.softminus(d[args.batch_size:]) - T.nnet.softplus(d[:args.batch_size]))
+        return T.mean(T.nnet.softminus(d[self.args.batch_size:]) - T.nnet.softplus(d[:self.args.batch_size]))
 
     def compile(self):
+        args = self.args
         # Helper function for rendering test images during training, or standalone inference mode.
         input_tensor, seed_tensor = T.tensor4(), T.tensor4()
         input_layers = {self.network['img']: input_tensor, self.network['seed']: seed_tensor}
@@ -431,45 +1147,558 @@ class Model(object):
         self.adversary_weight = theano.shared(np.array(0.0, dtype=theano.config.floatX))
         gen_losses = [self.loss_perceptual(percept_out) * args.perceptual_weight,
                       self.loss_total_variation(gen_out) * args.smoothness_weight,
-                      self.loss_adversarial(disc_out) * self.adversary_weight]
+                      self.loss_adversarial(disc_out) * self.adversary_weight,
+                      self.loss_pixel(gen_out, input_tensor) * args.pixel_weight]
         gen_params = lasagne.layers.get_all_params(self.network['out'], trainable=True)
         print('  - {} tensors learned for generator.'.format(len(gen_params)))
-        gen_updates = lasagne.updates.adam(sum(gen_losses, 0.0), gen_params, learning_rate=self.gen_lr)
+        gen_grads = T.grad(sum(gen_losses, 0.0), gen_params)
 
         # Discriminator loss function, parameters and updates.
         self.disc_lr = theano.shared(np.array(0.0, dtype=theano.config.floatX))
         disc_losses = [self.loss_discriminator(disc_out)]
         disc_params = list(itertools.chain(*[l.get_params() for k, l in self.network.items() if 'disc' in k]))
         print('  - {} tensors learned for discriminator.'.format(len(disc_params)))
-        grads = [g.clip(-5.0, +5.0) for g in T.grad(sum(disc_losses, 0.0), disc_params)]
-        disc_updates = lasagne.updates.adam(grads, disc_params, learning_rate=self.disc_lr)
+        disc_grads = [g.clip(-5.0, +5.0) for g in T.grad(sum(disc_losses, 0.0), disc_params)]
+
+        # Data-parallel training applies gradients separately, once they are averaged between processes.
+        outputs = gen_losses + [disc_out.mean(axis=(1,2,3))]
+        if args.train_processes > 1:
+            return self.compile_parallel([input_tensor, seed_tensor], outputs, (gen_grads, gen_params, self.gen_lr),
+                                                                               (disc_grads, disc_params, self.disc_lr))
 
         # Combined Theano function for updating both generator and discriminator at the same time.
+        gen_updates = lasagne.updates.adam(gen_grads, gen_params, learning_rate=self.gen_lr)
+        disc_updates = lasagne.updates.adam(disc_grads, disc_params, learning_rate=self.disc_lr)
         updates = collections.OrderedDict(list(gen_updates.items()) + list(disc_updates.items()))
-        self.fit = theano.function([input_tensor, seed_tensor], gen_losses + [disc_out.mean(axis=(1,2,3))], updates=updates)
+        self.updates = [updates]
+        self.fit = theano.function([input_tensor, seed_tensor], outputs, updates=updates)
+
+        if args.perceptual_cache: self.compile_cached(seed_tensor, gen_params, gen_grads, gen_updates)
+
+    def compile_parallel(self, inputs, outputs, *optimized):
+        """Split fitting into one function returning the losses followed by the gradients, and another function that
+        takes gradients as input to update parameters, so every process applies the same averaged update.
+        """
+        self.gradients = theano.function(inputs, outputs + list(itertools.chain(*[g for g, _, _ in optimized])))
+        self.outputs = len(outputs)
+
+        updates, grad_inputs, self.parallel_params = collections.OrderedDict(), [], []
+        for _, params, learning_rate in optimized:
+            placeholders = [p.type() for p in params]
+            updates.update(lasagne.updates.adam(placeholders, params, learning_rate=learning_rate))
+            grad_inputs.extend(placeholders)
+            self.parallel_params.extend(params)
+        self.updates = [updates]
+        self.apply_gradients = theano.function(grad_inputs, [], updates=updates)
+
+    def compile_cached(self, seed_tensor, gen_params, gen_grads, gen_updates):
+        """Separate functions for epochs that train the generator without the discriminator, where the features of the
+        real images can be computed once then cached, so VGG only runs on the generated images.  The updates are the
+        same as the generator's in `fit` with other gradients, so both share the optimizer state.
+        """
+        input_tensor, real_tensor = T.tensor4(), T.tensor4()
+        percept_layer = self.network[self.args.perceptual_layer]
+        real_out = lasagne.layers.get_output(percept_layer, {self.concatenated: input_tensor}, deterministic=True)
+        self.features = theano.function([input_tensor], real_out)
+
+        gen_out = lasagne.layers.get_output(self.network['out'], {self.network['seed']: seed_tensor})
+        fake_out = lasagne.layers.get_output(percept_layer, {self.concatenated: gen_out})
+        losses = [lasagne.objectives.squared_error(real_tensor, fake_out).mean() * self.args.perceptual_weight,
+                  self.loss_total_variation(gen_out) * self.args.smoothness_weight,
+                  self.loss_pixel(gen_out, input_tensor) * self.args.pixel_weight]
+        replace = dict(zip(gen_grads, T.grad(sum(losses, 0.0), gen_params)))
+        updates = collections.OrderedDict((v, theano.clone(u, replace=replace)) for v, u in gen_updates.items())
+        self.fit_cached = theano.function([input_tensor, seed_tensor, real_tensor], losses, updates=updates)
+
+
+class NumpyModel(object):
+    """Inference-only implementation of the generator using vectorized NumPy, loading the same parameters as `Model`
+    but without compiling anything.  Activations are stored as NHWC so convolutions are a single matrix product.
+    """
+
+    get_filename = Model.get_filename
+    load_model = Model.load_model
+    receptive_field = Model.receptive_field
+
+    def __init__(self, config=None):
+        self.args = copy_config(config)
+        config, params = self.load_model()
+        for k, v in config.items(): setattr(self.args, k, v)
+        self.args.zoom = 2**(self.args.generator_upscale - self.args.generator_downscale)
+        self.layers = self.setup_generator(params or self.initialize())
+        if self.args.quantize: self.float_layers, self.layers = self.layers, self.quantize(self.layers)
+
+    def initialize(self):
+        """Random parameters for the generator as configured, only used for benchmarking when no model is available.
+        """
+        args = self.args
+        params, units_iter = {}, extend(args.generator_filters)
+        def layer(name, units, inputs, size, prelu=True):
+            W = np.random.normal(0.0, math.sqrt(2.0 / (inputs * size * size)), (units, inputs, size, size))
+            params[name+'x' if prelu else name] = [W.astype(np.float32), np.zeros((units,), dtype=np.float32)]
+            if prelu: params[name+'>'] = [np.full((units,), 0.25, dtype=np.float32)]
+            return units
+
+        c = layer('iter.0', next(units_iter), 3, 7)
+        for i in range(0, args.generator_downscale):
+            c = layer('downscale%i'%i, next(units_iter), c, 4)
+        units = next(units_iter)
+        for i in range(0, args.generator_blocks):
+            c = layer('iter.%i-A'%(i+1), units, c, 3)
+        for i in range(0, args.generator_upscale):
+            u = next(units_iter)
+            c = layer('upscale%i.2'%i, u*4, c, 3) // 4
+        layer('out', 3, c, 7, prelu=False)
+        return params
+
+    def make_layer(self, name, params, stride=1, pad=1, prelu=True):
+        W, b = [np.asarray(p, dtype=np.float32) for p in params[name if not prelu else name+'x']]
+        # Lasagne flips filters as true convolution, while windows extracted below are in (channel, row, column) order.
+        kernel = np.ascontiguousarray(W[:,:,::-1,::-1].reshape(W.shape[0], -1).T)
+        layers = [('conv', kernel, b, W.shape[2], stride, pad)]
+        if prelu: layers.append(('prelu', np.asarray(params[name+'>'][0], dtype=np.float32) - 1.0))
+        return layers
+
+    def setup_generator(self, params):
+        args = self.args
+        layers = self.make_layer('iter.0', params, pad=3)
+        for i in range(0, args.generator_downscale):
+            layers += self.make_layer('downscale%i'%i, params, stride=2)
+        for i in range(0, args.generator_blocks):
+            block = self.make_layer('iter.%i-A'%(i+1), params)
+            layers += [('push',)] + block + [('sum',)] if args.generator_residual else block
+        for i in range(0, args.generator_upscale):
+            layers += self.make_layer('upscale%i.2'%i, params) + [('shuffle', 2)]
+        return layers + self.make_layer('out', params, pad=3, prelu=False)
+
+    def quantize(self, layers):
+        """Store activations with reduced precision, which saves memory but not time as NumPy only has fast matrix
+        products in float32.  For int8, kernels are rounded with one scale per output channel, and the input of every
+        convolution has one scale calibrated from the largest values seen when running the float32 layers on sample
+        images.  Kernels are kept as float32 so they aren't widened again for every tile.  For fp16, all activations
+        are stored as float16.
+        """
+        if self.args.quantize == 'fp16':
+            return [(op, params[0].astype(np.float16)) if op == 'prelu' else (op, *params) for op, *params in layers]
+
+        ranges = collections.defaultdict(float)
+        def observe(i, x): ranges[i] = max(ranges[i], float(np.percentile(np.abs(x), 99.99)))
+        samples = [scipy.ndimage.imread(f, mode='RGB') for f in self.args.quantize_samples] or [synthetic_image(256)]
+        for img in samples:
+            # Tiles are passed through one by one, as in rendering, since full images would use too much memory.
+            size = min(self.args.rendering_tile, *img.shape[:2])
+            for _ in range(4):
+                y, x = random.randint(0, img.shape[0] - size), random.randint(0, img.shape[1] - size)
+                tile = img[y:y+size,x:x+size] / 255.0 - 0.5
+                self.forward(np.transpose(tile, (2, 0, 1))[np.newaxis].astype(np.float32), layers, observe)
+
+        quantized = []
+        for i, (op, *params) in enumerate(layers):
+            if op != 'conv':
+                quantized.append((op, *params))
+                continue
+            kernel, bias, size, stride, pad = params
+            channels = np.abs(kernel).max(axis=0).clip(1E-8) / 127.0
+            inputs = max(ranges[i], 1E-8) / 127.0
+            quantized.append(('conv', np.round(kernel / channels).astype(np.float32), bias, size, stride, pad,
+                              (inputs, (channels * inputs).astype(np.float32))))
+        print('  - Quantized {} convolutions to int8 calibrated on {} image(s).'\
+              .format(sum(op == 'conv' for op, *_ in layers), len(samples)))
+        return quantized
+
+    def convolve(self, x, kernel, bias, size, stride, pad, scales=None, chunk=4096):
+        if scales is not None:
+            x = np.round(x / scales[0]).clip(-127.0, 127.0).astype(np.int8)
+        x = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)), mode='constant')
+        n, h, w, c = x.shape
+        h, w = (h - size) // stride + 1, (w - size) // stride + 1
+        sn, sh, sw, sc = x.strides
+        windows = np.lib.stride_tricks.as_strided(x, shape=(n, h, w, c, size, size),
+                                                  strides=(sn, sh*stride, sw*stride, sc, sh, sw))
+        windows = windows.reshape(n * h * w, c * size * size)
+        if windows.dtype == np.float32:
+            output = np.dot(windows, kernel)
+        else:
+            # NumPy only has fast matrix products in float32, so compact windows are widened a chunk at a time.
+            output = np.empty((n * h * w, kernel.shape[1]), dtype=np.float32)
+            for i in range(0, n * h * w, chunk):
+                np.dot(windows[i:i+chunk].astype(np.float32), kernel, out=output[i:i+chunk])
+        if scales is not None: output *= scales[1]
+        output += bias
+        return output.reshape(n, h, w, -1).astype(x.dtype if x.dtype == np.float16 else np.float32, copy=False)
+
+    def reshuffle(self, x, r):
+        n, h, w, c = x.shape
+        x = x.reshape(n, h, w, c // (r*r), r, r).transpose(0, 1, 4, 2, 5, 3)
+        return np.ascontiguousarray(x).reshape(n, h * r, w * r, c // (r*r))
+
+    def predict(self, seed):
+        """Same signature as the compiled Theano function, returning both the seed and generated images as NCHW.
+        """
+        return seed, self.forward(seed, self.layers).astype(np.float32, copy=False)
+
+    def precision(self, layers):
+        """Type of the activations, which are stored as float16 if the rectifiers were quantized to it.
+        """
+        return np.float16 if any(op == 'prelu' and p[0].dtype == np.float16 for op, *p in layers) else np.float32
+
+    def forward(self, seed, layers, observe=None):
+        dtype = self.precision(layers)
+        x, stack = np.ascontiguousarray(seed.transpose(0, 2, 3, 1), dtype=dtype), []
+        for i, (op, *params) in enumerate(layers):
+            if observe and op == 'conv': observe(i, x)
+            if op == 'conv': x = self.convolve(x, *params)
+            elif op == 'shuffle': x = self.reshuffle(x, *params)
+            elif op == 'push': stack.append(x)
+            elif op == 'sum': x += stack.pop()
+            elif op == 'prelu':
+                # Parametric rectifier in-place, negative values are scaled by (alpha - 1) then added back.
+                negative = np.minimum(x, 0.0)
+                negative *= params[0]
+                x += negative
+        return x.transpose(0, 3, 1, 2)
+
+    def estimate_memory(self, size, layers=None):
+        """Approximate number of bytes for rendering one tile, dominated by the input windows of each convolution
+        which are stored with the precision of the activations, and the float32 output.
+        """
+        layers = layers or self.layers
+        peak, h, c, itemsize = 0, size, 3, np.dtype(self.precision(layers)).itemsize
+        for op, *params in layers:
+            if op == 'conv':
+                kernel, _, k, stride, _, *scales = params
+                o, b = h // stride, 1 if scales else itemsize
+                peak, h, c = max(peak, b*h*h*c + b*o*o*kernel.shape[0] + 4*o*o*kernel.shape[1]), o, kernel.shape[1]
+            if op == 'shuffle':
+                h, c = h * params[0], c // params[0] ** 2
+        return peak
+
+
+class GradientAverager(object):
+    """Replacement for `Model.fit` in data-parallel training.  Each process writes its gradients into one row of a
+    shared buffer, then all rows are averaged once every process reached the barrier.  The buffer is doubled so the
+    next step can be written while slower processes are still reading the previous one.
+    """
+
+    def __init__(self, model, rank, barrier, buffer):
+        self.model, self.rank, self.barrier, self.step = model, rank, barrier, 0
+        self.shapes = [p.get_value().shape for p in model.parallel_params]
+        self.offsets = np.cumsum([0] + [int(np.prod(s)) for s in self.shapes])
+        self.buffer = np.frombuffer(buffer, dtype=np.float32).reshape((2, barrier.parties, -1))
+
+    def __call__(self, images, seeds):
+        output = self.model.gradients(images, seeds)
+        rows, self.step = self.buffer[self.step % 2], self.step + 1
+        count = self.model.outputs
+        np.concatenate([g.ravel() for g in output[count:]], out=rows[self.rank])
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            raise KeyboardInterrupt
+
+        average = rows.mean(axis=0)
+        self.model.apply_gradients(*[average[a:b].reshape(s) for a, b, s in zip(self.offsets, self.offsets[1:],
+                                                                                 self.shapes)])
+        return output[:count]
+
+
+class AsyncWriter(threading.Thread):
+    """Background thread that writes the files queued by the training loop, so fitting continues meanwhile.  The
+    queue is bounded to limit the memory used by snapshots that are waiting to be written.
+    """
+
+    def __init__(self):
+        super(AsyncWriter, self).__init__(daemon=True)
+        self.queue = queue.Queue(maxsize=4)
+        self.start()
+
+    def submit(self, function, *params):
+        self.queue.put((function, params))
+
+    def run(self):
+        while True:
+            function, params = self.queue.get()
+            try:
+                function(*params)
+            except Exception as e:
+                warn('Could not write files in the background.', '  - {}'.format(e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+
+class TrainingMetrics(object):
+    """Instrumentation of the training loop, recording time spent waiting for the data loader, fitting the model and
+    writing files, along with the buffer levels.  Each step is appended as one line of JSON to the file specified.
+    """
 
+    def __init__(self, args, loader):
+        self.args, self.loader, self.step, self.recent = args, loader, 0, []
+        self.file = open(args.train_metrics, 'a') if args.train_metrics else None
+        self.last = (time.time(), loader.status()['produced'])
+
+    def write(self, record):
+        if self.file is None: return
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def record_step(self, epoch, copy, fit, losses):
+        status, now = self.loader.status(), time.time()
+        rate = (status['produced'] - self.last[1]) / max(now - self.last[0], 1E-9)
+        self.last, self.step = (now, status['produced']), self.step + 1
+
+        record = {'type': 'step', 'epoch': epoch, 'step': self.step, 'time': now, 'copy': copy,
+                  'wait': self.loader.waited, 'fit': fit, 'ready': status['ready'],
+                  'available': status['available'], 'produced_per_second': rate,
+                  'losses': [float(l) for l in losses]}
+        self.write(record)
+        self.recent.append(record)
+        if self.args.train_summary and len(self.recent) >= self.args.train_summary: self.summarize()
+
+    def record_epoch(self, epoch, progress, save):
+        self.write({'type': 'epoch', 'epoch': epoch, 'time': time.time(), 'progress': progress, 'save': save})
+
+    def summarize(self):
+        def mean(k): return sum(r[k] for r in self.recent) / len(self.recent)
+        busy = mean('copy') + mean('fit')
+        print('\n  - {} batches, loading {:4.1f}% at {:4.3f}s, fitting {:4.1f}% at {:4.3f}s, buffer {:.0f} ready '
+              '{:.0f} available, loader {:4.1f} fragments/s.'.format(len(self.recent), 100.0 * mean('copy') / busy,
+              mean('copy'), 100.0 * mean('fit') / busy, mean('fit'), mean('ready'), mean('available'),
+              mean('produced_per_second')))
+        self.recent = []
+
+
+class FeatureCache(object):
+    """Bounded store of perceptual features computed from real images, keyed by the identity of each fragment as
+    reported by the data loader.  Features are kept as float16 and the least recently used ones are dropped.
+    """
+
+    def __init__(self, capacity):
+        self.capacity, self.entries = capacity, collections.OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def lookup(self, keys, images, compute):
+        missing = [i for i, k in enumerate(keys) if k not in self.entries]
+        if len(missing) > 0:
+            for i, f in zip(missing, compute(images[missing])):
+                self.entries[keys[i]] = f.astype(np.float16)
+        self.hits, self.misses = self.hits + len(keys) - len(missing), self.misses + len(missing)
+
+        for k in keys: self.entries.move_to_end(k)
+        features = np.stack([self.entries[k] for k in keys]).astype(np.float32)
+        while len(self.entries) > self.capacity: self.entries.popitem(last=False)
+        return features
+
+
+class TileHistory(object):
+    """Padded inputs and outputs of the tiles last rendered at each position of a video frame.  If the input of a
+    tile differs from it by less than the threshold for every pixel, the previous output is reused.  Inputs are only
+    stored when rendered, so slow changes can't accumulate over many frames.
+    """
+
+    def __init__(self, threshold):
+        self.threshold, self.tiles, self.reused, self.checked = threshold / 255.0, {}, 0, 0
+
+    def lookup(self, key, tile):
+        previous, self.checked = self.tiles.get(key), self.checked + 1
+        if previous is None or previous[0].shape != tile.shape or np.abs(previous[0] - tile).max() > self.threshold:
+            return None
+        self.reused += 1
+        return previous[1]
+
+    def store(self, key, tile, output):
+        self.tiles[key] = (tile, output)
+
+
+class TileCache(object):
+    """Outputs of tiles that don't need the generator.  Flat tiles, with variance below the threshold in every
+    channel, are upscaled by repeating pixels.  Others identical to a tile rendered before are found by hashing their
+    content in a bounded LRU cache, shared by all the images of a run and by the threads of the server.
+    """
+
+    def __init__(self, flat, capacity, zoom):
+        self.flat, self.zoom = None if flat is None else flat / 255.0 ** 2, zoom
+        self.capacity, self.entries = capacity, collections.OrderedDict()
+        self.flats, self.hits, self.misses = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def lookup(self, tile):
+        if self.flat is not None and tile.var(axis=(1, 2)).max() <= self.flat:
+            with self.lock: self.flats += 1
+            return tile.repeat(self.zoom, axis=1).repeat(self.zoom, axis=2)
+
+        key = hashlib.sha1(tile.tobytes()).digest() if self.capacity > 0 else None
+        with self.lock:
+            output = self.entries.get(key)
+            if output is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return output
+
+    def store(self, tile, output):
+        if self.capacity == 0: return
+        key = hashlib.sha1(tile.tobytes()).digest()
+        with self.lock:
+            self.entries[key] = output.copy()
+            while len(self.entries) > self.capacity: self.entries.popitem(last=False)
 
 
 class NeuralEnhancer(object):
 
-    def __init__(self, loader):
+    def __init__(self, loader=False, config=None):
+        self.args = args = copy_config(config)
         if args.train:
             print('{}Training {} epochs on random image sections with batch size {}.{}'\
                   .format(ansi.BLUE_B, args.epochs, args.batch_size, ansi.BLUE))
         else:
-            if len(args.files) == 0: error("Specify the image(s) to enhance on the command-line.")
-            print('{}Enhancing {} image(s) specified on the command-line.{}'\
-                  .format(ansi.BLUE_B, len(args.files), ansi.BLUE))
-
-        self.thread = DataLoader() if loader else None
-        self.model = Model()
+            if len(args.files) > 0:
+                print('{}Enhancing {} image(s) specified on the command-line.{}'\
+                      .format(ansi.BLUE_B, len(args.files), ansi.BLUE))
+
+        self.thread, self.rank = self.setup_loader() if loader else None, 0
+        if loader and args.perceptual_cache and not isinstance(self.thread, FragmentStore):
+            warn("Cached features are only reused if a fragment is sampled again before the loader replaces it, which "
+                 "is rare except with fragments from `--train-prepare`.", "  - Check the hit rate after each epoch.")
+        self.teacher = self.setup_teacher() if args.train and args.distill else None
+        if args.quantize and args.backend != 'numpy':
+            error("Quantized inference is only supported by the NumPy backend, specify `--backend=numpy`.")
+        if args.backend == 'numpy':
+            if args.train: error("Training requires the Theano backend, the NumPy implementation is inference only.")
+            self.model = NumpyModel(self.args)
+            if args.backend_tolerance is not None: self.verify_backend()
+        else:
+            self.model = Model(self.args)
+        # The model completes its copy of the options with the settings of its generator, used for rendering too.
+        self.args = args = self.model.args
+        if not args.train: self.setup_rendering()
+        self.cache = FeatureCache(args.perceptual_cache) if loader and args.perceptual_cache else None
+        self.predict, self.history = self.model.predict, None
+        self.tiles = TileCache(args.rendering_flat, args.rendering_cache, args.zoom)\
+                     if args.rendering_flat is not None or args.rendering_cache > 0 else None
 
         print('{}'.format(ansi.ENDC))
 
+    def setup_loader(self):
+        if os.path.isfile(os.path.join(self.args.train, 'fragments.json')):
+            return FragmentStore(self.args)
+        return DataLoaderPool(self.args) if self.args.buffer_workers > 0 else DataLoader(self.args)
+
+    def verify_backend(self):
+        """Compare the output of the NumPy implementation with the compiled Theano version on a random input.
+        """
+        seed = np.random.uniform(-0.5, +0.5, size=(2, 3, 64, 64)).astype(np.float32)
+        expected, actual = Model(self.args).predict(seed)[1], self.model.predict(seed)[1]
+        difference = np.abs(expected - actual).max()
+        if difference > self.args.backend_tolerance:
+            error("NumPy backend differs from Theano by {:4.2e}, above tolerance {:4.2e}."\
+                  .format(difference, self.args.backend_tolerance))
+        print('  - Verified NumPy backend matches Theano within {:4.2e}.'.format(difference))
+
+    def setup_rendering(self):
+        """Pick the smallest tile overlap that renders without seams based on the receptive field of the generator.
+        Feathered pixels outside a tile are blended within that overlap, so they never have less than `field - f`
+        pixels of context and only carry a small weight.
+        """
+        args = self.args
+        field, f = self.model.receptive_field(), args.rendering_feather
+        if args.rendering_overlap is None:
+            args.rendering_overlap = max(f, field)
+        if args.rendering_overlap < f:
+            error("Tiles can't be feathered further than they overlap, using {} and {} pixels respectively."\
+                  .format(args.rendering_overlap, f))
+
+        def redundancy(s, p): return ((s + 2 * p) / s) ** 2
+        print('  - Receptive field of generator is {} pixels, using overlap {} with {:3.2f}x computation per tile.'\
+              .format(field, args.rendering_overlap, redundancy(args.rendering_tile, args.rendering_overlap)))
+
+        if args.rendering_report:
+            overlaps = sorted(set([field // 4, field // 2, field, args.rendering_overlap]))
+            print('    {:>6}{}'.format('tile', ''.join('{:>8}'.format('p=%i' % p) for p in overlaps)))
+            for s in sorted(set([32, 48, 64, 80, 96, 128, 192, 256, args.rendering_tile])):
+                print('    {:>6}{}'.format(s, ''.join('{:>7.2f}x'.format(redundancy(s, p)) for p in overlaps)))
+
+        if args.rendering_tune: self.tune_rendering()
+
+    def tune_rendering(self, tiles=(48, 64, 80, 96, 128, 160, 192, 256), batches=(1, 2, 4, 8, 16)):
+        """Pick the tile and batch size that render the most megapixels per second within the memory budget, by
+        timing the generator on random tiles, then the number of concurrent renders that use the cores best, which is
+        only reported.  The results are cached for this model file, host, backend and budget, so later runs start tuned.
+        """
+        args = self.args
+        p, cores = args.rendering_overlap, args.rendering_cores or os.cpu_count() or 1
+        models = [self.model.get_filename(absolute=True, extension=e) for e in ('weights', 'pkl.bz2')]
+        stamp = ['{}:{}'.format(m, os.path.getmtime(m)) for m in models if os.path.exists(m)]
+        key = '|'.join([self.model.get_filename()] + stamp + [platform.node(), args.backend, str(args.quantize),
+                                                              str(p), str(args.rendering_memory), str(cores)])
+        cache = os.path.join(os.path.expanduser('~'), '.cache', 'neural-enhance', 'tuning.json')
+        entries = json.load(open(cache, 'r')) if os.path.exists(cache) else {}
+        if key not in entries:
+            entries[key] = self.measure_rendering(tiles, batches, cores)
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            with open(cache + '.tmp', 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.replace(cache + '.tmp', cache)
+
+        tuned = entries[key]
+        args.rendering_tile, args.rendering_batch = tuned['tile'], tuned['batch']
+        print('  - Tuned rendering to tile {} and batch {} at {:4.2f} megapixels/s.'\
+              .format(tuned['tile'], tuned['batch'], tuned['speed']))
+        if tuned['processes'] > 1:
+            print('  - Running {} processes side by side would reach {:4.2f} megapixels/s, this is not done for you.'\
+                  .format(tuned['processes'], tuned['total']))
+
+    def measure_rendering(self, tiles, batches, cores, repeat=2):
+        args = self.args
+        p, budget = args.rendering_overlap, args.rendering_memory * 1024 ** 2
+        def speed(tile, batch, threads=1):
+            inputs = np.random.uniform(-0.5, +0.5, (batch, 3, tile+2*p, tile+2*p)).astype(np.float32)
+            def render():
+                for _ in range(repeat): self.model.predict(inputs)
+            self.model.predict(inputs)
+            workers = [threading.Thread(target=render) for _ in range(threads)]
+            start = time.time()
+            for w in workers: w.start()
+            for w in workers: w.join()
+            return threads * repeat * batch * tile ** 2 / (time.time() - start) / 1e6
+
+        # Tile sizes are probed from smallest to largest, increasing the batch while it fits and helps.
+        best = (0.0, None, None)
+        for tile in tiles:
+            memory, tile_best = self.model.estimate_memory(tile + 2 * p), 0.0
+            for batch in [b for b in batches if b * memory <= budget]:
+                result = speed(tile, batch)
+                print('  - Probed tile {} with batch {} at {:4.2f} megapixels/s.'.format(tile, batch, result))
+                if result > best[0]: best = (result, tile, batch)
+                if result <= tile_best: break
+                tile_best = result
+        if best[1] is None:
+            error("Not even one tile of size {} fits in a budget of {}MB.".format(tiles[0], args.rendering_memory))
+
+        # Concurrent renders each have the same memory budget, and are added until throughput stops improving.  They
+        # are measured with threads, which compiled Theano functions don't support, so only for the NumPy backend.
+        total, processes = best[0], 1
+        for count in [c for c in (2, 4, 8, 16, 32, 64) if c <= cores and args.backend == 'numpy']:
+            result = speed(best[1], best[2], threads=count)
+            if result < total * 1.1: break
+            total, processes = result, count
+        return {'tile': best[1], 'batch': best[2], 'speed': best[0], 'processes': processes, 'total': total}
+
+    def feather_mask(self, height, width):
+        """Weights for blending a rendered tile with its neighbors, ramping linearly across the feathered border.
+        """
+        def ramp(n): return np.minimum(np.arange(n) + 0.5, n - np.arange(n) - 0.5) / (2 * f * self.args.zoom)
+        f = self.args.rendering_feather
+        return np.outer(ramp(height).clip(0.0, 1.0), ramp(width).clip(0.0, 1.0)).astype(np.float32)
+
     def imsave(self, fn, img):
         scipy.misc.toimage(np.transpose(img + 0.5, (1, 2, 0)).clip(0.0, 1.0) * 255.0, cmin=0, cmax=255).save(fn)
 
     def show_progress(self, orign, scald, repro):
+        args = self.args
         os.makedirs('valid', exist_ok=True)
         for i in range(args.batch_size):
             self.imsave('valid/%s_%03i_origin.png' % (args.model, i), orign[i])
@@ -477,45 +1706,74 @@ class NeuralEnhancer(object):
             self.imsave('valid/%s_%03i_reprod.png' % (args.model, i), repro[i])
 
     def decay_learning_rate(self):
-        l_r, t_cur = args.learning_rate, 0
+        l_r, t_cur = self.args.learning_rate, 0
 
         while True:
             yield l_r
             t_cur += 1
-            if t_cur % args.learning_period == 0: l_r *= args.learning_decay
+            if t_cur % self.args.learning_period == 0: l_r *= self.args.learning_decay
 
     def train(self):
+        args = self.args
         seed_size = args.batch_shape // args.zoom
         images = np.zeros((args.batch_size, 3, args.batch_shape, args.batch_shape), dtype=np.float32)
         seeds = np.zeros((args.batch_size, 3, seed_size, seed_size), dtype=np.float32)
         learning_rate = self.decay_learning_rate()
+        metrics, writer = TrainingMetrics(self.args, self.thread), AsyncWriter()
+        first = self.model.load_checkpoint() if args.resume else 0
+        for _ in range(first): next(learning_rate)
+        epoch = first - 1
         try:
             average, start = None, time.time()
-            for epoch in range(args.epochs):
-                total, stats = None, None
+            for epoch in range(first, args.epochs):
+                total, stats, epoch_start = None, None, time.time()
                 l_r = next(learning_rate)
                 if epoch >= args.generator_start: self.model.gen_lr.set_value(l_r)
                 if epoch >= args.discriminator_start: self.model.disc_lr.set_value(l_r)
 
+                # Before the discriminator is involved, features of real images can come from the cache.
+                cached = self.cache is not None and epoch < min(args.discriminator_start, args.adversarial_start)
                 for _ in range(args.epoch_size):
+                    timer = time.time()
                     self.thread.copy(images, seeds)
-                    output = self.model.fit(images, seeds)
-                    losses = np.array(output[:3], dtype=np.float32)
-                    stats = (stats + output[3]) if stats is not None else output[3]
+                    copy_time, timer = time.time() - timer, time.time()
+                    # Rendering the targets with a teacher is compute, so it's measured along with fitting.
+                    if self.teacher is not None: images[:] = self.teacher.predict(seeds)[1]
+                    if cached:
+                        real = self.cache.lookup(self.thread.sampled, images, self.model.features)
+                        perceptual, smoothness, pixel = self.model.fit_cached(images, seeds, real)
+                        output = [perceptual, smoothness, 0.0, pixel, np.zeros(2*args.batch_size, np.float32)]
+                    else:
+                        output = self.model.fit(images, seeds)
+                    losses = np.array(output[:4], dtype=np.float32)
+                    metrics.record_step(epoch, copy_time, time.time() - timer, losses)
+                    stats = (stats + output[4]) if stats is not None else output[4]
                     total = total + losses if total is not None else losses
                     l = np.sum(losses)
                     assert not np.isnan(losses).any()
                     average = l if average is None else average * 0.95 + 0.05 * l
                     print('↑' if l > average else '↓', end='', flush=True)
 
-                scald, repro = self.model.predict(seeds)
-                self.show_progress(images, scald, repro)
+                timer = time.time()
+                throughput = args.epoch_size * args.batch_size * args.train_processes / (timer - epoch_start)
+                if self.rank == 0:
+                    scald, repro = self.model.predict(seeds)
+                    writer.submit(self.show_progress, images.copy(), scald, repro)
+                    fidelity = psnr(repro, images) if self.teacher is not None else None
+                progress_time, save_time = time.time() - timer, 0.0
                 total /= args.epoch_size
                 stats /= args.epoch_size
-                totals, labels = [sum(total)] + list(total), ['total', 'prcpt', 'smthn', 'advrs']
+                totals, labels = [sum(total)] + list(total), ['total', 'prcpt', 'smthn', 'advrs', 'pixel']
                 gen_info = ['{}{}{}={:4.2e}'.format(ansi.WHITE_B, k, ansi.ENDC, v) for k, v in zip(labels, totals)]
                 print('\rEpoch #{} at {:4.1f}s, lr={:4.2e}{}'.format(epoch+1, time.time()-start, l_r, ' '*(args.epoch_size-30)))
                 print('  - generator {}'.format(' '.join(gen_info)))
+                print('  - trained {:4.1f} images/s with {} process(es).'.format(throughput, args.train_processes))
+                if self.teacher is not None and self.rank == 0:
+                    print('  - student reproduces teacher with PSNR {:4.2f}dB.'.format(fidelity))
+                if cached:
+                    print('  - cached features of real images for {} fragments, {} hits and {} misses for {:3.1f}%.'\
+                          .format(len(self.cache.entries), self.cache.hits, self.cache.misses,
+                                  100.0 * self.cache.hits / max(1, self.cache.hits + self.cache.misses)))
 
                 real, fake = stats[:args.batch_size], stats[args.batch_size:]
                 print('  - discriminator', real.mean(), len(np.where(real > 0.5)[0]),
@@ -524,64 +1782,743 @@ class NeuralEnhancer(object):
                     print('  - generator now optimizing against discriminator.')
                     self.model.adversary_weight.set_value(args.adversary_weight)
                     running = None
-                if (epoch+1) % args.save_every == 0:
+                if (epoch+1) % args.save_every == 0 and self.rank == 0:
                     print('  - saving current generator layers to disk...')
-                    self.model.save_generator()
+                    timer = time.time()
+                    self.model.save_generator(writer)
+                    if args.save_keep > 0: self.model.save_checkpoint(writer, epoch)
+                    save_time = time.time() - timer
+                metrics.record_epoch(epoch, progress_time, save_time)
 
         except KeyboardInterrupt:
             pass
 
         print('\n{}Trained {}x super-resolution for {} epochs.{}'\
                 .format(ansi.CYAN_B, args.zoom, epoch+1, ansi.CYAN))
-        self.model.save_generator()
+        writer.flush()
+        if self.rank == 0: self.model.save_generator()
+        if self.rank == 0 and self.teacher is not None: self.compare_teacher(seeds)
         print(ansi.ENDC)
 
-    def match_histograms(self, A, B, rng=(0.0, 255.0), bins=64):
-        (Ha, Xa), (Hb, Xb) = [np.histogram(i, bins=bins, range=rng, density=True) for i in [A, B]]
-        X = np.linspace(rng[0], rng[1], bins, endpoint=True)
-        Hpa, Hpb = [np.cumsum(i) * (rng[1] - rng[0]) ** 2 / float(bins) for i in [Ha, Hb]]
-        inv_Ha = scipy.interpolate.interp1d(X, Hpa, bounds_error=False, fill_value='extrapolate')
-        map_Hb = scipy.interpolate.interp1d(Hpb, X, bounds_error=False, fill_value='extrapolate')
-        return map_Hb(inv_Ha(A).clip(0.0, 255.0))
+    def setup_teacher(self):
+        """Load the trained model to distill for inference only, from the same options except for the model name.
+        """
+        args = self.args
+        if args.distill == args.model:
+            error("The distilled model needs a different name than its teacher `{}`.".format(args.distill))
+        teacher = Model(copy_config(self.args, model=args.distill, train=False))
+        if teacher.args.zoom != args.zoom:
+            error("Teacher model zooms {}x, but the student is configured for {}x."\
+                  .format(teacher.args.zoom, args.zoom))
+        if args.perceptual_cache:
+            warn("Caching perceptual features is not supported when distilling, option is ignored.")
+            args.perceptual_cache = 0
+        return teacher
+
+    def compare_teacher(self, seeds, repeat=3):
+        """Measure how much faster the student generator is than its teacher on a batch, and how close it gets.
+        """
+        timings, outputs, sizes = [], [], []
+        for model in (self.teacher, self.model):
+            outputs.append(model.predict(seeds)[1])
+            start = time.time()
+            for _ in range(repeat): model.predict(seeds)
+            timings.append((time.time() - start) / repeat)
+            sizes.append(sum(p.get_value().size for _, l in model.list_generator_layers() for p in l.get_params()))
+        print('  - Student has {:,} parameters instead of {:,}, renders a batch in {:4.3f}s instead of {:4.3f}s for '
+              '{:3.2f}x speed, at PSNR {:4.2f}dB.'.format(sizes[1], sizes[0], timings[1], timings[0],
+                                                          timings[0] / timings[1], psnr(outputs[1], outputs[0])))
+
+    def tile_batch_size(self):
+        """Number of tiles to pass through the network at once, either specified or fitted to the memory budget.
+        """
+        args = self.args
+        if args.rendering_batch > 0: return args.rendering_batch
+        tile_bytes = self.model.estimate_memory(args.rendering_tile + 2 * args.rendering_overlap)
+        return max(1, args.rendering_memory * 1024 ** 2 // tile_bytes)
+
+    def report_tiles(self):
+        if self.tiles is None: return
+        print('  - Upscaled {} flat tiles directly, reused {} from the cache and rendered {} with the generator.'\
+              .format(self.tiles.flats, self.tiles.hits, self.tiles.misses))
+
+    def render_batch(self, image, output, weight, shape, batch):
+        """Gather the padded tiles at the given coordinates into a single tensor, padding the edge tiles to full size,
+        then run them through the generator and scatter the results back into the zoomed output.  When feathering, the
+        output has an extra border and the tiles are accumulated along with their blending weights.
+        """
+        args = self.args
+        s, p, f, z = args.rendering_tile, args.rendering_overlap, args.rendering_feather, args.zoom
+        inputs = np.zeros((len(batch), 3, s+p*2, s+p*2), dtype=np.float32)
+        for i, (y, x) in enumerate(batch):
+            tile = image[y:y+p*2+s,x:x+p*2+s,:]
+            tile = np.pad(tile, ((0, s+p*2-tile.shape[0]), (0, s+p*2-tile.shape[1]), (0, 0)), mode='edge')
+            inputs[i] = np.transpose(tile / 255.0 - 0.5, (2, 0, 1))
+
+        if self.history is None and self.tiles is None:
+            *_, repro = self.predict(inputs)
+        else:
+            # Tiles are reused from the previous video frame if possible, then from the cache, or rendered.
+            repro = [self.history.lookup(k, t) if self.history else None for k, t in zip(batch, inputs)]
+            fresh = [i for i, r in enumerate(repro) if r is None]
+            for i in fresh: repro[i] = self.tiles.lookup(inputs[i]) if self.tiles else None
+            changed = [i for i in fresh if repro[i] is None]
+            if len(changed) > 0:
+                *_, rendered = self.predict(inputs[changed])
+                for i, r in zip(changed, rendered):
+                    if self.tiles: self.tiles.store(inputs[i], r)
+                    repro[i] = r
+            for i in (fresh if self.history else []): self.history.store(batch[i], inputs[i], repro[i])
+
+        for (y, x), r in zip(batch, repro):
+            h, w = min(s, shape[0] - y) + 2 * f, min(s, shape[1] - x) + 2 * f
+            tile = np.transpose(r + 0.5, (1, 2, 0))[(p-f)*z:(p-f+h)*z,(p-f)*z:(p-f+w)*z,:]
+            if weight is None:
+                output[y*z:(y+h)*z,x*z:(x+w)*z,:] = tile
+                continue
+            mask = self.feather_mask(h * z, w * z)
+            output[y*z:(y+h)*z,x*z:(x+w)*z,:] += tile * mask[:,:,np.newaxis]
+            weight[y*z:(y+h)*z,x*z:(x+w)*z] += mask
 
     def process(self, original):
+        args = self.args
         # Snap the image to a shape that's compatible with the generator (2x, 4x)
         s = 2 ** max(args.generator_upscale, args.generator_downscale)
         by, bx = original.shape[0] % s, original.shape[1] % s
         original = original[by-by//2:original.shape[0]-by//2,bx-bx//2:original.shape[1]-bx//2,:]
 
-        # Prepare paded input image as well as output buffer of zoomed size.
-        s, p, z = args.rendering_tile, args.rendering_overlap, args.zoom
+        # Prepare paded input image as well as output buffer of zoomed size, with a border for feathered tiles.
+        s, p, f, z = args.rendering_tile, args.rendering_overlap, args.rendering_feather, args.zoom
         image = np.pad(original, ((p, p), (p, p), (0, 0)), mode='reflect')
-        output = np.zeros((original.shape[0] * z, original.shape[1] * z, 3), dtype=np.float32)
-
-        # Iterate through the tile coordinates and pass them through the network.
-        for y, x in itertools.product(range(0, original.shape[0], s), range(0, original.shape[1], s)):
-            img = np.transpose(image[y:y+p*2+s,x:x+p*2+s,:] / 255.0 - 0.5, (2, 0, 1))[np.newaxis].astype(np.float32)
-            *_, repro = self.model.predict(img)
-            output[y*z:(y+s)*z,x*z:(x+s)*z,:] = np.transpose(repro[0] + 0.5, (1, 2, 0))[p*z:-p*z,p*z:-p*z,:]
-            print('.', end='', flush=True)
-        output = output.clip(0.0, 1.0) * 255.0
+        output = np.zeros(((original.shape[0] + 2*f) * z, (original.shape[1] + 2*f) * z, 3), dtype=np.float32)
+        weight = np.zeros(output.shape[:2], dtype=np.float32) if f else None
+
+        # Iterate through the tile coordinates in batches and pass them through the network.
+        tiles = itertools.product(range(0, original.shape[0], s), range(0, original.shape[1], s))
+        batch_size = self.tile_batch_size()
+        for batch in iter(lambda: list(itertools.islice(tiles, batch_size)), []):
+            self.render_batch(image, output, weight, original.shape, batch)
+            print('.' * len(batch), end='', flush=True)
+        if f:
+            output = output[f*z:-f*z,f*z:-f*z] / weight[f*z:-f*z,f*z:-f*z,np.newaxis]
+        output = (output.clip(0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
 
         # Match color histograms if the user specified this option.
         if args.rendering_histogram:
-            for i in range(3):
-                output[:,:,i] = self.match_histograms(output[:,:,i], original[:,:,i])
+            apply_tables(output, histogram_tables(color_histograms(output), color_histograms(original)))
 
-        return scipy.misc.toimage(output, cmin=0, cmax=255)
+        return PIL.Image.fromarray(output)
 
+    def enhance(self, image):
+        """Enhance an RGB image stored as an array of shape (height, width, 3) with values in range [0, 255], and
+        return the output as a uint8 array zoomed by the factor of the model.
+        """
+        return np.asarray(self.process(image), dtype=np.uint8)
 
-if __name__ == "__main__":
-    if args.train:
-        args.zoom = 2**(args.generator_upscale - args.generator_downscale)
-        enhancer = NeuralEnhancer(loader=True)
+    def process_files(self, filenames, saved=None):
+        """Enhance images in order while background threads decode the next few files and encode finished ones, so
+        the model is not idle during file operations.  The number of images in flight either way is bounded.  Files
+        that fail are skipped with a warning and not passed to `saved`, so they can be retried later.
+        """
+        def decode(filename): return scipy.ndimage.imread(filename, mode='RGB')
+        def encode(image, filename):
+            image.save(os.path.splitext(filename)[0]+'_ne%ix.png' % self.args.zoom)
+            if saved: saved(filename)
+        def skip(filename, e):
+            warn('Could not enhance `{}` as image.'.format(filename), '  - {}'.format(e),
+                 '  - Skipping this file, it is not recorded as done.')
+        def finish(filename, future):
+            try: future.result()
+            except Exception as e: skip(filename, e)
+
+        depth = max(1, self.args.rendering_pipeline)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2 * depth) as pool:
+            pending, decoded, encoded = iter(filenames), collections.deque(), collections.deque()
+            for filename in itertools.islice(pending, depth):
+                decoded.append((filename, pool.submit(decode, filename)))
+
+            while len(decoded) > 0:
+                filename, future = decoded.popleft()
+                for upcoming in itertools.islice(pending, 1):
+                    decoded.append((upcoming, pool.submit(decode, upcoming)))
+                print(filename, end=' ')
+                try:
+                    encoded.append((filename, pool.submit(encode, self.process(future.result()), filename)))
+                except Exception as e:
+                    skip(filename, e)
+                while len(encoded) > depth: finish(*encoded.popleft())
+                print(flush=True)
+            for filename, future in encoded: finish(filename, future)
+
+    def process_video(self, source, target):
+        """Enhance all the frames of a video one by one, reusing tiles that did not change since the previous frame
+        if a threshold is specified.
+        """
+        if self.args.video_threshold is not None: self.history = TileHistory(self.args.video_threshold)
+        writer = None
+        for i, (name, frame) in enumerate(read_frames(source)):
+            print('  - frame #{}'.format(i), end=' ')
+            output = self.enhance(frame)
+            writer = writer or VideoWriter(target, source, output.shape[1], output.shape[0])
+            writer.write(name, output)
+            print(flush=True)
+        if writer is not None: writer.close()
+
+        if self.history is not None:
+            print('  - Reused {} of {} tiles from previous frames, saving {:3.1f}% of the work.'\
+                  .format(self.history.reused, self.history.checked,
+                          100.0 * self.history.reused / max(1, self.history.checked)))
+        self.history = None
+
+    def process_stream(self, original, basename):
+        """Render the image in horizontal bands of one tile each, building the reflect padding of every band on the fly
+        and writing finished rows straight to disk, so memory depends on the image width and not its area.
+        """
+        args = self.args
+        # Snap the image to a shape that's compatible with the generator, using offsets rather than copying.
+        s = 2 ** max(args.generator_upscale, args.generator_downscale)
+        by, bx = original.shape[0] % s, original.shape[1] % s
+        height, width, oy, ox = original.shape[0] - by, original.shape[1] - bx, by - by//2, bx - bx//2
+
+        s, p, f, z = args.rendering_tile, args.rendering_overlap, args.rendering_feather, args.zoom
+        Writer = {'png': PNGWriter, 'npy': NPYWriter}[args.rendering_stream]
+        writer = Writer(basename + Writer.extension, width * z, height * z)
+
+        # Matching histograms requires the whole output, so it's rendered to a temporary file then remapped.
+        if args.rendering_histogram:
+            final, writer = writer, NPYWriter(basename + '.tmp.npy', width * z, height * z)
+            histogram = np.zeros((3, 256), dtype=np.int64)
+        columns = reflect_indices(np.arange(-p, width+p), width) + ox
+        batch_size = self.tile_batch_size()
+        carry = None
+        for y in range(0, height, s):
+            # Rows past the bottom of the padded image repeat the edge, the same as tiles rendered in memory.
+            rows = reflect_indices(np.arange(y-p, y+s+p).clip(-p, height+p-1), height) + oy
+            band, shape = original[rows][:,columns], (min(s, height-y), width)
+            output = np.zeros(((shape[0] + 2*f) * z, (width + 2*f) * z, 3), dtype=np.float32)
+            weight = np.zeros(output.shape[:2], dtype=np.float32) if f else None
+
+            tiles = ((0, x) for x in range(0, width, s))
+            for batch in iter(lambda: list(itertools.islice(tiles, batch_size)), []):
+                self.render_batch(band, output, weight, shape, batch)
+                print('.' * len(batch), end='', flush=True)
+
+            # With feathering, bands overlap so the rows shared with the next band are carried over and finished later.
+            if f:
+                if carry is not None:
+                    output[:2*f*z] += carry[0]
+                    weight[:2*f*z] += carry[1]
+                start, end = (f*z if y == 0 else 0), ((shape[0] + f) * z if y + s >= height else shape[0] * z)
+                carry = (output[shape[0]*z:], weight[shape[0]*z:])
+                output = output[start:end,f*z:-f*z] / weight[start:end,f*z:-f*z,np.newaxis]
+            output = (output.clip(0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+            if args.rendering_histogram: histogram += color_histograms(output)
+            writer.write(output)
+        writer.close()
+
+        if args.rendering_histogram:
+            tables = histogram_tables(histogram, color_histograms(original[oy:oy+height,ox:ox+width]))
+            rendered = np.load(basename + '.tmp.npy', mmap_mode='r')
+            for y in range(0, rendered.shape[0], s * z):
+                final.write(apply_tables(np.array(rendered[y:y+s*z]), tables))
+            final.close()
+            del rendered
+            os.remove(basename + '.tmp.npy')
+
+
+#======================================================================================================================
+# Parallel Training
+#======================================================================================================================
+
+def train_worker(enhancer, rank, barrier, buffer):
+    """Entry point of a forked training process, which shares the compiled model of its parent but loads its own
+    images.  Only the first process prints progress and saves files.
+    """
+    random.seed()
+    np.random.seed()
+    if rank > 0:
+        sys.stdout, enhancer.args.train_metrics = open(os.devnull, 'w'), None
+    enhancer.rank, enhancer.thread = rank, enhancer.setup_loader()
+    enhancer.model.fit = GradientAverager(enhancer.model, rank, barrier, buffer)
+    try:
         enhancer.train()
-    else:
-        enhancer = NeuralEnhancer(loader=False)
-        for filename in args.files:
+    finally:
+        barrier.abort()
+
+def train_parallel(args):
+    """Compile the model once, then fork processes that each fit a batch and average their gradients, so the
+    effective batch size is multiplied by the number of processes.
+    """
+    if not args.device.startswith('cpu'):
+        error("Training in multiple processes is only supported on the CPU, forking after compiling for `{}` isn't."\
+              .format(args.device), "  - Use `--device=cpu` or train with `--train-processes=1`.")
+    if args.perceptual_cache:
+        warn("Caching perceptual features is not supported in data-parallel training, option is ignored.")
+        args = copy_config(args, perceptual_cache=0)
+
+    enhancer = NeuralEnhancer(loader=False, config=args)
+    count = sum(p.get_value().size for p in enhancer.model.parallel_params)
+    print('  - Averaging {:,} gradients between {} processes, effective batch size {}.'\
+          .format(count, args.train_processes, args.batch_size * args.train_processes))
+
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(args.train_processes)
+    buffer = context.RawArray('f', 2 * args.train_processes * count)
+    workers = [context.Process(target=train_worker, args=(enhancer, rank, barrier, buffer))
+               for rank in range(args.train_processes)]
+    for w in workers: w.start()
+    for w in workers:
+        while w.is_alive():
+            try:
+                w.join()
+            except KeyboardInterrupt:
+                pass
+
+
+#======================================================================================================================
+# Incremental Processing
+#======================================================================================================================
+
+def hash_file(filename, chunk=1<<20):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for data in iter(lambda: f.read(chunk), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+class Manifest(object):
+    """Record of the inputs already enhanced, storing a hash of their content along with the model and rendering
+    settings used.  Files are skipped if neither changed and the output still exists.  Without a filename, the
+    records are only kept in memory for watching folders.
+    """
+
+    def __init__(self, filename, enhancer):
+        self.filename, self.lock, self.args = filename, threading.Lock(), enhancer.args
+        model, args = enhancer.model, enhancer.args
+        # The converted `.weights` file holds the same parameters, so only the original is hashed if available.
+        models = [model.get_filename(absolute=True, extension=e) for e in ('pkl.bz2', 'weights')]
+        models = [m for m in models if os.path.exists(m)]
+        self.settings = {'model': model.get_filename(), 'fingerprint': hash_file(models[0]) if models else None,
+                         'zoom': args.zoom, 'tile': args.rendering_tile, 'overlap': args.rendering_overlap,
+                         'feather': args.rendering_feather, 'histogram': args.rendering_histogram,
+                         'flat': args.rendering_flat,
+                         'backend': args.backend, 'quantize': args.quantize, 'stream': args.rendering_stream}
+        self.entries = {}
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+
+    def output(self, filename):
+        return os.path.splitext(filename)[0]+'_ne%ix.%s' % (self.args.zoom, self.args.rendering_stream or 'png')
+
+    def identify(self, filename):
+        """Hash the content of the file, unless its size and modification time match the last record.
+        """
+        stat, entry = os.stat(filename), self.entries.get(filename, {})
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            return entry['hash'], stat
+        return hash_file(filename), stat
+
+    def outdated(self, filename):
+        entry = self.entries.get(filename)
+        if entry is None or entry['settings'] != self.settings or not os.path.exists(self.output(filename)):
+            return True
+        return self.identify(filename)[0] != entry['hash']
+
+    def update(self, filename):
+        digest, stat = self.identify(filename)
+        with self.lock:
+            self.entries[filename] = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                      'settings': self.settings}
+            if self.filename is None: return
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(self.filename + '.tmp', self.filename)
+
+def enhance_files(enhancer, filenames, manifest=None):
+    args = enhancer.args
+    todo = [f for f in filenames if manifest is None or manifest.outdated(f)]
+    if len(todo) < len(filenames):
+        print('  - Skipping {} file(s) already up to date.'.format(len(filenames) - len(todo)))
+    if args.rendering_stream:
+        for filename in todo:
             print(filename, end=' ')
-            img = scipy.ndimage.imread(filename, mode='RGB')
-            out = enhancer.process(img)
-            out.save(os.path.splitext(filename)[0]+'_ne%ix.png' % args.zoom)
+            try:
+                enhancer.process_stream(imread_rows(filename), os.path.splitext(filename)[0]+'_ne%ix' % args.zoom)
+            except Exception as e:
+                warn('Could not enhance `{}` as image.'.format(filename), '  - {}'.format(e),
+                     '  - Skipping this file, it is not recorded as done.')
+                continue
+            if manifest: manifest.update(filename)
             print(flush=True)
+    else:
+        enhancer.process_files(todo, manifest.update if manifest else None)
+
+def watch_files(enhancer, manifest):
+    """Poll the file patterns given on the command-line and enhance new or modified inputs.  Files that changed
+    since the last poll may still be written, so they are left for the next one, as are files that failed.
+    """
+    args = enhancer.args
+    print('{}Watching {} pattern(s) every {}s for new images, press Ctrl+C to stop.{}'\
+          .format(ansi.BLUE_B, len(args.files), args.watch, ansi.BLUE))
+    try:
+        while True:
+            filenames = sorted(set(itertools.chain(*[glob.glob(p) for p in args.files])))
+            filenames = [f for f in filenames if not os.path.splitext(f)[0].endswith('_ne%ix' % args.zoom)
+                                              and time.time() - os.path.getmtime(f) > args.watch]
+            if any(manifest.outdated(f) for f in filenames):
+                enhance_files(enhancer, filenames, manifest)
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+
+
+#======================================================================================================================
+# Benchmarking
+#======================================================================================================================
+
+def synthetic_image(size):
+    """Smooth color gradients with some edges and noise, so the benchmark doesn't depend on downloading images.
+    """
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    image = np.stack([np.sin(x * 7.0 + y * 3.0), np.cos(x * 2.0 - y * 5.0), (x * 8.0).astype(int) % 2 - 0.5], axis=2)
+    image += np.random.normal(scale=0.1, size=image.shape)
+    return ((image.clip(-1.0, 1.0) + 1.0) * 127.5).astype(np.uint8)
+
+def psnr(image, reference, low=-0.5, high=+0.5):
+    """Peak signal-to-noise ratio in decibels of images clipped to the given range, by default the normalized range
+    used by the generator.
+    """
+    mse = np.mean((np.clip(image, low, high) - np.clip(reference, low, high)) ** 2)
+    return 10.0 * math.log10((high - low) ** 2 / max(mse, 1E-10))
+
+def quality(reference, image):
+    """Peak signal-to-noise ratio in decibels and mean structural similarity of the luminance of two uint8 images.
+    """
+    a, b = [np.dot(np.asarray(i, dtype=np.float64), [0.299, 0.587, 0.114]) for i in (reference, image)]
+
+    def blur(x): return scipy.ndimage.gaussian_filter(x, sigma=1.5)
+    ma, mb = blur(a), blur(b)
+    va, vb, cov = blur(a * a) - ma ** 2, blur(b * b) - mb ** 2, blur(a * b) - ma * mb
+    c1, c2 = (0.01 * 255.0) ** 2, (0.03 * 255.0) ** 2
+    ssim = ((2 * ma * mb + c1) * (2 * cov + c2)) / ((ma ** 2 + mb ** 2 + c1) * (va + vb + c2))
+    return psnr(b, a, 0.0, 255.0), float(ssim.mean())
+
+def quantization_report(enhancer):
+    """Render images with the float32 and the quantized generator through the tiled renderer, then print the
+    difference in quality, time and memory used for weights and one batch of tiles.  Flat and cached tiles would be
+    the same for both generators, so every tile is rendered.
+    """
+    args = enhancer.args
+    model, images = enhancer.model, [(f, scipy.ndimage.imread(f, mode='RGB')) for f in args.files]
+    images = images or [('synthetic-%i' % s, synthetic_image(s)) for s in args.benchmark_sizes]
+    tile, batch, memory = args.rendering_tile + 2 * args.rendering_overlap, enhancer.tile_batch_size(), []
+    for layers in (model.float_layers, model.layers):
+        weights = sum(p.nbytes for op, *params in layers for p in params if isinstance(p, np.ndarray))
+        memory.append((weights / 1024**2, model.estimate_memory(tile, layers) * batch / 1024**2))
+
+    print('  - Weights use {:4.2f}MB in float32 and {:4.2f}MB in {}, tiles use {:4.1f}MB and {:4.1f}MB.'\
+          .format(memory[0][0], memory[1][0], args.quantize, memory[0][1], memory[1][1]))
+    cache, enhancer.tiles = enhancer.tiles, None
+    for name, img in images:
+        timings, outputs, quantized = [], [], model.layers
+        for layers in (model.float_layers, quantized):
+            model.layers, start = layers, time.time()
+            outputs.append(enhancer.enhance(img))
+            timings.append(time.time() - start)
+        model.layers = quantized
+        ratio, ssim = quality(*outputs)
+        print('\r  - {} PSNR={:4.2f}dB SSIM={:6.4f}, took {:4.2f}s in float32 and {:4.2f}s in {} for {:3.2f}x speed.'\
+              .format(name, ratio, ssim, timings[0], timings[1], args.quantize, timings[0] / timings[1]))
+    enhancer.tiles = cache
+
+def resident_memory():
+    """Memory of this process currently in RAM, in megabytes, or `None` if the platform doesn't provide it.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 ** 2
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemoryMonitor(threading.Thread):
+    """Sample the resident memory while one benchmark run is in progress, since the peak reported by the operating
+    system is for the whole process and only grows.  Returns the peak and its increase since the run started.
+    """
+
+    def __init__(self, interval=0.002):
+        super(MemoryMonitor, self).__init__(daemon=True)
+        self.interval, self.done = interval, threading.Event()
+        self.initial = self.peak = resident_memory()
+        if self.initial is not None: self.start()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, resident_memory())
+
+    def stop(self):
+        if self.initial is None: return None, None
+        self.done.set()
+        self.join()
+        self.peak = max(self.peak, resident_memory())
+        return self.peak, self.peak - self.initial
+
+def benchmark(enhancer, build_time):
+    """Render synthetic and reference images with a sweep of tile sizes, overlaps and batch sizes, then store the
+    throughput, latency of network calls and memory usage as JSON so different versions can be compared.
+    """
+    args = enhancer.args
+    latencies, model_predict = [], enhancer.predict
+    def predict(seeds):
+        start = time.time()
+        result = model_predict(seeds)
+        latencies.append((time.time() - start) / len(seeds))
+        return result
+    enhancer.predict = predict
+
+    images = [('synthetic-%i' % s, synthetic_image(s)) for s in args.benchmark_sizes]
+    images += [(f, scipy.ndimage.imread(f, mode='RGB')) for f in args.files]
+    if len(images) == 0:
+        error("There are no images to benchmark, specify files or sizes of synthetic images with `--benchmark-sizes`.")
+    results = {'version': __version__, 'backend': args.backend, 'model': enhancer.model.get_filename(),
+               'zoom': args.zoom, 'build_time': build_time, 'runs': []}
+
+    # The first network call usually includes extra setup, like allocating memory, so it's reported separately.
+    start = time.time()
+    enhancer.process(images[0][1][:64,:64])
+    results['warmup_time'] = time.time() - start
+
+    overlaps = args.benchmark_overlaps or [enhancer.model.receptive_field()]
+    for tile, overlap, batch in itertools.product(args.benchmark_tiles, overlaps, args.benchmark_batches):
+        args.rendering_tile, args.rendering_overlap, args.rendering_batch = tile, overlap, batch
+        for name, img in images:
+            del latencies[:]
+            monitor, start = MemoryMonitor(), time.time()
+            enhancer.process(img)
+            elapsed, tiles = time.time() - start, sorted(latencies)
+            memory, increase = monitor.stop()
+            def percentile(p): return tiles[min(len(tiles)-1, int(p * len(tiles)))]
+            run = {'image': name, 'width': img.shape[1], 'height': img.shape[0], 'tile': tile, 'overlap': overlap,
+                   'batch': batch, 'time': elapsed, 'megapixels_per_second': img.size / 3 / elapsed / 1e6,
+                   'tile_latency_p50': percentile(0.5), 'tile_latency_p90': percentile(0.9),
+                   'tile_latency_p99': percentile(0.99), 'peak_memory_mb': memory, 'memory_increase_mb': increase}
+            results['runs'].append(run)
+            print('\r  - {} tile={} overlap={} batch={} at {:4.2f} megapixels/s, {:4.1f}ms per tile.'\
+                  .format(name, tile, overlap, batch, run['megapixels_per_second'], run['tile_latency_p50'] * 1000.0))
+
+    json.dump(results, open(args.benchmark, 'w'), indent=2)
+    print('{}Saved benchmark results of {} runs to `{}`.{}'.format(ansi.BLUE_B, len(results['runs']), args.benchmark,
+                                                                 ansi.ENDC))
+
+
+#======================================================================================================================
+# Enhancement Server
+#======================================================================================================================
+
+class TileBatcher(threading.Thread):
+    """Run the tiles from concurrent requests through a single model, merging the batches that arrive within a short
+    time window into shared calls to `predict`.  Requests are admitted as a whole before any of their tiles are queued,
+    so a client is either refused straight away when the server is busy or gets its full image.
+    """
+
+    def __init__(self, args, predict):
+        super(TileBatcher, self).__init__(daemon=True)
+        self.args, self.queue = args, queue.Queue()
+        self.slots = threading.BoundedSemaphore(args.server_queue)
+        self.model_predict = predict
+        self.calls, self.tiles = 0, 0
+        self.start()
+
+    def admit(self):
+        """Reserve a place for one request, waiting at most the batching window, and return whether it succeeded.
+        Each admitted request must call `release` once it's done.
+        """
+        return self.slots.acquire(timeout=self.args.server_window / 1000.0)
+
+    def release(self):
+        self.slots.release()
+
+    def predict(self, seeds):
+        """Same signature as `Model.predict`, blocking until the tiles were processed.
+        """
+        item = (seeds, threading.Event(), [])
+        self.queue.put(item)
+        item[1].wait()
+        if isinstance(item[2][0], Exception): raise item[2][0]
+        return seeds, item[2][0]
+
+    def run(self):
+        while True:
+            items, deadline = [self.queue.get()], time.time() + self.args.server_window / 1000.0
+            while sum(len(i[0]) for i in items) < self.args.server_batch:
+                try:
+                    items.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            try:
+                *_, repro = self.model_predict(np.concatenate([i[0] for i in items]))
+                self.calls, self.tiles = self.calls + 1, self.tiles + len(repro)
+            except Exception as e:
+                repro = e
+            offset = 0
+            for seeds, event, result in items:
+                result.append(repro if isinstance(repro, Exception) else repro[offset:offset+len(seeds)])
+                offset += len(seeds)
+                event.set()
+
+
+class ServerMetrics(object):
+    """Thread-safe statistics about requests processed by the server, reported as JSON on `GET /metrics`.
+    """
+
+    def __init__(self, batcher):
+        self.batcher, self.lock, self.start = batcher, threading.Lock(), time.time()
+        self.latencies = collections.deque(maxlen=1000)
+        self.requests, self.rejected, self.pixels = 0, 0, 0
+
+    def record(self, latency, pixels):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests, self.pixels = self.requests + 1, self.pixels + pixels
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def summary(self):
+        with self.lock:
+            latencies, elapsed = sorted(self.latencies), time.time() - self.start
+            def percentile(p): return latencies[min(len(latencies)-1, int(p * len(latencies)))] if latencies else None
+            return {'requests': self.requests, 'rejected': self.rejected, 'uptime': elapsed,
+                    'latency_p50': percentile(0.5), 'latency_p95': percentile(0.95), 'latency_p99': percentile(0.99),
+                    'megapixels_per_second': self.pixels / elapsed / 1e6, 'queued_batches': self.batcher.queue.qsize(),
+                    'network_calls': self.batcher.calls,
+                    'tiles_per_call': self.batcher.tiles / max(1, self.batcher.calls)}
+
+
+class EnhanceHandler(http.server.BaseHTTPRequestHandler):
+    """Accept encoded images with `POST`, replying with the enhanced version as PNG.
+    """
+
+    def reply(self, code, content_type, data):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/metrics': return self.send_error(404)
+        self.reply(200, 'application/json', json.dumps(self.server.metrics.summary()).encode('utf-8'))
+
+    def do_POST(self):
+        start, data = time.time(), self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            img = np.asarray(PIL.Image.open(io.BytesIO(data)).convert('RGB'))
+        except Exception:
+            return self.send_error(400, 'Could not decode the request body as an image.')
+        if not self.server.batcher.admit():
+            self.server.metrics.reject()
+            return self.send_error(503, 'Too many requests in progress, try again later.')
+        try:
+            out = self.server.enhancer.process(img)
+        except Exception as e:
+            warn('Could not enhance {}x{} image.'.format(img.shape[1], img.shape[0]), '  - {}'.format(e))
+            return self.send_error(500, 'Could not enhance the image.')
+        finally:
+            self.server.batcher.release()
+
+        buffer = io.BytesIO()
+        out.save(buffer, format='png')
+        self.reply(200, 'image/png', buffer.getvalue())
+        self.server.metrics.record(time.time() - start, img.shape[0] * img.shape[1])
+        print('  - Enhanced {}x{} image in {:4.2f}s.'.format(img.shape[1], img.shape[0], time.time() - start))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(enhancer):
+    """Keep the model loaded and enhance images posted over HTTP, either on a TCP port or a unix domain socket.
+    """
+    args = enhancer.args
+    batcher = TileBatcher(args, enhancer.predict)
+    enhancer.predict = batcher.predict
+
+    if ':' in args.server:
+        host, port = args.server.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), EnhanceHandler)
+    else:
+        if os.path.exists(args.server): os.remove(args.server)
+        server = ThreadingUnixServer(args.server, EnhanceHandler)
+    server.enhancer, server.batcher, server.metrics = enhancer, batcher, ServerMetrics(batcher)
+
+    print('{}Serving on `{}`, POST images and GET /metrics.{}'.format(ansi.BLUE_B, args.server, ansi.ENDC))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def main(argv=None):
+    """Command-line interface, parsing the arguments given or from `sys.argv` and running the mode selected.
+    """
+    args = parser.parse_args(argv)
+    print("""{}   {}Super Resolution for images and videos powered by Deep Learning!{}
+  - Code licensed as AGPLv3, models under CC BY-NC-SA.{}""".format(ansi.CYAN_B, __doc__, ansi.CYAN, ansi.ENDC))
+
+    if args.convert:
+        for filename in args.files:
+            convert_weights(filename)
+    elif args.train_prepare:
+        args.zoom = 2**(args.generator_upscale - args.generator_downscale)
+        prepare_fragments(args, args.train_prepare)
+    elif args.train:
+        args.zoom = 2**(args.generator_upscale - args.generator_downscale)
+        if args.train_processes > 1:
+            train_parallel(args)
+        else:
+            enhancer = NeuralEnhancer(loader=True, config=args)
+            enhancer.train()
+    elif args.server:
+        serve(NeuralEnhancer(loader=False, config=args))
+    elif args.quantize_report:
+        if not args.quantize: error("Specify the type of quantization to report on, for example `--quantize=int8`.")
+        quantization_report(NeuralEnhancer(loader=False, config=args))
+    elif args.benchmark:
+        start = time.time()
+        enhancer = NeuralEnhancer(loader=False, config=args)
+        benchmark(enhancer, time.time() - start)
+    elif args.video:
+        if any(not os.path.isdir(f) for f in args.files) and shutil.which('ffmpeg') is None:
+            error("Enhancing video files requires `ffmpeg` and `ffprobe` installed, or use a folder of frames.")
+        enhancer = NeuralEnhancer(loader=False, config=args)
+        for source in args.files:
+            print(source)
+            base, extension = os.path.splitext(source) if os.path.isfile(source) else (source.rstrip('/'), '')
+            enhancer.process_video(source, base + '_ne%ix' % enhancer.args.zoom + extension)
+        enhancer.report_tiles()
         print(ansi.ENDC)
+    else:
+        if len(args.files) == 0 and not (args.rendering_report or args.watch):
+            error("Specify the image(s) to enhance on the command-line.")
+        enhancer = NeuralEnhancer(loader=False, config=args)
+        manifest = Manifest(args.manifest, enhancer) if args.manifest or args.watch else None
+        if args.watch:
+            watch_files(enhancer, manifest)
+        else:
+            enhance_files(enhancer, args.files, manifest)
+        enhancer.report_tiles()
+        print(ansi.ENDC)
+
+
+if __name__ == "__main__":
+    main()